@@ -206,6 +206,7 @@ class DocumentAdmin(admin.ModelAdmin):
     @never_cache
     def rank_up_document_conversion(self, request):
         from universal.models import DelayedTask
+        from services.conversion_scheduler import ConversionScheduler
         data = {"ranked_up": False}
         if request.is_ajax() and request.method == "POST":
             document_id = request.POST.get('document_id')
@@ -213,9 +214,57 @@ class DocumentAdmin(admin.ModelAdmin):
                 DelayedTask.objects.document_conversion_rank_up(
                     document_id=document_id,
                     rank=1)
+                ConversionScheduler.rank_up(document_id, rank=1)
             data['ranked_up'] = True
         return HttpResponse(json.dumps(data), content_type="application/json")
 
+    @method_decorator(staff_member_required)
+    @never_cache
+    def duplicated(self, request):
+        """
+        Near duplicates of a document (document_id)
+        or duplicate clusters of a school (school)
+        """
+        from services.near_duplicates import NearDuplicateIndex
+
+        document = None
+        clusters = []
+        document_id = request.GET.get('document_id')
+        school_id = request.GET.get('school')
+
+        if document_id:
+            document = get_object_or_404(Document, id=document_id)
+            similar = NearDuplicateIndex.get_similar(document.id)
+            similarities = dict(similar)
+            documents = Document.objects.in_bulk(list(similarities))
+            clusters = [[
+                (documents[similar_id], similarities[similar_id])
+                for similar_id, _ in similar if similar_id in documents
+            ]]
+        elif school_id:
+            document_clusters = NearDuplicateIndex.get_clusters(school_id)
+            documents = Document.objects.in_bulk([
+                document_id
+                for cluster in document_clusters
+                for document_id in cluster
+            ])
+            clusters = [
+                [(documents[document_id], None)
+                 for document_id in cluster if document_id in documents]
+                for cluster in document_clusters
+            ]
+
+        template = 'admin/document/duplicated.html'
+        context = {
+            'document': document,
+            'clusters': clusters,
+            'app_label': self.model._meta.app_label,
+            'verbose_name': self.model._meta.verbose_name.title(),
+            'obj_name': self.model._meta.object_name.lower(),
+            'media': self.media,
+        }
+        return render(request, template, context)
+
     @method_decorator(staff_member_required)
     def doc_details(self, request):
         found = False
@@ -0,0 +1,20 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class DocumentConfig(AppConfig):
+    name = 'document'
+
+    def ready(self):
+        from models import invalidate_membership_cache
+        from services.membership_cache import MembershipCache
+
+        # The membership model belongs to another app, it is known once
+        # all apps are loaded. A receiver without a sender would run on
+        # every save and disable fast deletes of every model
+        membership_model = \
+            MembershipCache.get_membership_relation().related_model
+        for signal in (post_save, post_delete):
+            signal.connect(
+                invalidate_membership_cache, sender=membership_model,
+                dispatch_uid='document_invalidate_membership_cache')
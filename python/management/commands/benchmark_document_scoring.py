@@ -0,0 +1,203 @@
+import datetime
+import json
+import random
+import resource
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from models import (
+    Document, DocumentPaywallSetting, DocumentWeight,
+    DocumentWeightGeneration, LikesBookmarks
+)
+from services.document_weight import DocumentWeightService
+from services.paywall_threshold import PaywallThresholdCache
+from services.scoring_metrics import StubMetricsHook
+
+
+class Command(BaseCommand):
+    help = ('Benchmark document scoring on a synthetic corpus. '
+            'Creates documents and paywall settings in the local database')
+
+    benchmark_username = 'scoring-benchmark'
+    chunk_size = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales', default='10000,100000,1000000',
+            help='Comma separated numbers of documents')
+        parser.add_argument(
+            '--likes-per-document', type=int, default=2,
+            help='Average number of likes/dislikes of a document')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of scoring processes')
+        parser.add_argument(
+            '--output', default='document_scoring_benchmark.json',
+            help='Path of the JSON report')
+        parser.add_argument(
+            '--keep-data', action='store_true',
+            help="Don't remove synthetic documents after the benchmark")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError('The benchmark writes synthetic documents, '
+                               'run it against a local database only')
+
+        scales = sorted(int(scale) for scale in options['scales'].split(','))
+        user, _ = User.objects.get_or_create(
+            username=self.benchmark_username)
+
+        started_at = timezone.now()
+        results = []
+        try:
+            for scale in scales:
+                self.generate_documents(
+                    user, scale, options['likes_per_document'])
+                result = self.benchmark(scale, options['workers'])
+                results.append(result)
+                self.stdout.write(json.dumps(result))
+        finally:
+            if not options['keep_data']:
+                self.remove_data(user, started_at)
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'workers': options['workers'],
+            'results': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write(f"Report saved to {options['output']}")
+
+    def generate_documents(self, user, scale, likes_per_document):
+        """
+        Add synthetic published documents until there are scale of them
+        """
+        existing_count = Document.objects.filter(notetaker=user).count()
+        now = timezone.now()
+
+        for offset in range(existing_count, scale, self.chunk_size):
+            documents = []
+            for number in range(offset, min(offset + self.chunk_size, scale)):
+                likes = random.randint(0, likes_per_document * 2)
+                dislikes = random.randint(0, likes_per_document)
+                documents.append(Document(
+                    title=f'benchmark-{number}',
+                    document=f'raw/benchmark-{number}.pdf',
+                    notetaker=user,
+                    status=Document.PUBLISHED,
+                    dc_success=True,
+                    views=random.randint(0, 10000),
+                    publish_date=now - datetime.timedelta(
+                        days=random.randint(0, 1500)),
+                    scraping_status=random.choice(
+                        (Document.NOT_SCRAPED, Document.SKIPPED)),
+                    likes_count=likes,
+                    dislikes_count=dislikes,
+                ))
+            documents = Document.objects.bulk_create(documents)
+
+            bookmarks = []
+            for document in documents:
+                bookmarks += [
+                    LikesBookmarks(user=user, document=document, like=True)
+                    for _ in range(document.likes_count)
+                ]
+                bookmarks += [
+                    LikesBookmarks(user=user, document=document, dislike=True)
+                    for _ in range(document.dislikes_count)
+                ]
+            LikesBookmarks.objects.bulk_create(
+                bookmarks, batch_size=self.chunk_size)
+
+    def remove_data(self, user, started_at):
+        """
+        Remove paywall settings and synthetic documents of the benchmark
+        chunk by chunk, the generation that was active before the
+        benchmark becomes active again
+        """
+        paywall_settings = DocumentPaywallSetting.objects.filter(
+            created_at__gte=started_at)
+
+        # The previous generation is the last activated one again
+        DocumentWeightGeneration.objects \
+            .filter(paywall_setting__in=paywall_settings) \
+            .update(activated_at=None)
+        PaywallThresholdCache.invalidate()
+
+        self.delete_in_chunks(DocumentWeight.objects.filter(
+            document_paywall_setting__in=paywall_settings))
+        paywall_settings.delete()
+
+        # Like counters and dirty marks of the removed documents don't
+        # matter, the bookmarks were created without signals as well
+        self.delete_in_chunks(
+            LikesBookmarks.objects.filter(document__notetaker=user),
+            send_signals=False)
+        self.delete_in_chunks(Document.objects.filter(notetaker=user))
+
+    def delete_in_chunks(self, queryset, send_signals=True):
+        model = queryset.model
+        while True:
+            ids = list(
+                queryset.values_list('id', flat=True)[:self.chunk_size])
+            if not ids:
+                return
+
+            chunk = model.objects.filter(id__in=ids)
+            if send_signals:
+                chunk.delete()
+            else:
+                chunk._raw_delete(chunk.db)
+
+    @staticmethod
+    def reset_peak_rss():
+        """
+        Reset VmHWM of the process on Linux, so that ru_maxrss is measured
+        per scale. Elsewhere the peak of the whole process is reported
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_peak_rss_kb():
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def benchmark(self, scale, workers):
+        self.reset_peak_rss()
+        metrics_hook = StubMetricsHook()
+
+        DocumentWeightService(metrics_hooks=[metrics_hook]).run(
+            collect_garbage=False, workers=workers)
+
+        summary = metrics_hook.summaries[-1]
+        return {
+            'scale': scale,
+            'documents': summary['documents'],
+            'seconds': summary['seconds'],
+            'documents_per_second': summary['documents_per_second'],
+            'peak_rss_kb': self.get_peak_rss_kb(),
+            'peak_children_rss_kb': resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss,
+            'queries': summary['queries'],
+            'query_budget': DocumentWeightService.get_query_budget(
+                summary['documents']),
+            'query_seconds': summary['query_seconds'],
+            'rule_seconds': {
+                name: histogram['sum']
+                for name, histogram in summary['rules'].items()
+            },
+        }
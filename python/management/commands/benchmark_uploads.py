@@ -0,0 +1,452 @@
+import base64
+import http.client
+import json
+import os
+import statistics
+import threading
+import tempfile
+import time
+import urllib.parse
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+)
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+
+import views
+from accounts.models import UserProfile
+from models import Document
+
+
+class UploadClient:
+    """
+    plupload client: multipart chunks of one file over a keep-alive
+    connection
+    """
+
+    def __init__(self, base_url, headers):
+        url = urllib.parse.urlsplit(base_url)
+        connection_class = (
+            http.client.HTTPSConnection if url.scheme == 'https'
+            else http.client.HTTPConnection)
+        self.connection = connection_class(url.netloc, timeout=300)
+        self.headers = headers
+
+    @staticmethod
+    def encode_multipart(fields, file_data):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'.encode())
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; '
+            f'filename="blob"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        parts.append(file_data)
+        parts.append(f'\r\n--{boundary}--\r\n'.encode())
+        return (b''.join(parts),
+                f'multipart/form-data; boundary={boundary}')
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = dict(self.headers)
+        if content_type:
+            headers['Content-Type'] = content_type
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        if response.status >= 400:
+            raise CommandError(
+                f'{method} {path}: {response.status} {content[:200]!r}')
+        return content
+
+    def upload(self, path, name, data, chunk_size, extra_fields):
+        """
+        :return (chunk latencies, last response)
+        """
+        chunks = max((len(data) + chunk_size - 1) // chunk_size, 1)
+        unique = uuid.uuid4().hex
+        latencies = []
+        content = b''
+        for chunk in range(chunks):
+            fields = {
+                'name': name,
+                'unique': unique,
+                'chunk': chunk,
+                'chunks': chunks,
+                'chunk_size': chunk_size,
+                **extra_fields,
+            }
+            body, content_type = self.encode_multipart(
+                fields, data[chunk * chunk_size:(chunk + 1) * chunk_size])
+
+            start_time = time.perf_counter()
+            content = self.request('POST', path, body, content_type)
+            latencies.append(time.perf_counter() - start_time)
+        return latencies, content
+
+    def close(self):
+        self.connection.close()
+
+
+class Command(BaseCommand):
+    help = ('Benchmark upload throughput of document_upload_redesign or '
+            'seed_upload_document with concurrent plupload clients '
+            'against a running local server')
+
+    benchmark_username = 'upload-benchmark'
+    poll_interval = 0.05
+    id_placeholder = 987654321
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', default='http://127.0.0.1:8000',
+            help='Base URL of the local server')
+        parser.add_argument(
+            '--target', choices=('redesign', 'seed'), default='redesign',
+            help='Upload endpoint')
+        parser.add_argument(
+            '--upload-path',
+            help='Path of the upload view, found in the URLconf by default')
+        parser.add_argument(
+            '--status-path',
+            help='Path of the upload status view with {id} placeholder, '
+                 'found in the URLconf by default')
+        parser.add_argument(
+            '--clients', type=int, default=8,
+            help='Number of concurrent clients')
+        parser.add_argument(
+            '--uploads-per-client', type=int, default=4,
+            help='Number of files every client uploads')
+        parser.add_argument(
+            '--sizes', default='1,10,50',
+            help='Comma separated file sizes in MB, used in turn')
+        parser.add_argument(
+            '--chunk-size', type=float, default=2,
+            help='Chunk size in MB')
+        parser.add_argument(
+            '--seed-credentials',
+            help='user:password of the basic auth of seed uploads')
+        parser.add_argument(
+            '--worker-pids',
+            help='Comma separated pids of server workers, '
+                 'gunicorn and runserver processes by default')
+        parser.add_argument(
+            '--temp-dirs', default=f'media/tmp,{tempfile.gettempdir()}',
+            help='Comma separated directories of temporary upload files')
+        parser.add_argument(
+            '--output', default='upload_benchmark.json',
+            help='Path of the JSON report')
+        parser.add_argument(
+            '--keep-data', action='store_true',
+            help="Don't remove uploaded documents after the benchmark")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError('The benchmark uploads synthetic documents, '
+                               'run it against a local server only')
+
+        self.options = options
+        target = options['target']
+        upload_path, status_path = self.get_paths(target)
+        headers = self.get_headers(target)
+        self.worker_pids = self.get_worker_pids()
+        self.temp_dirs = [
+            os.path.abspath(path)
+            for path in options['temp_dirs'].split(',')
+        ]
+
+        sizes = [
+            int(float(size) * 1024 * 1024)
+            for size in options['sizes'].split(',')
+        ]
+        chunk_size = int(options['chunk_size'] * 1024 * 1024)
+        jobs = [
+            (client, number, sizes[number % len(sizes)])
+            for client in range(options['clients'])
+            for number in range(options['uploads_per_client'])
+        ]
+
+        for pid in self.worker_pids:
+            self.reset_peak_rss(pid)
+        sampler = TempDiskSampler(self.temp_dirs)
+        sampler.start()
+
+        # Ids of created documents, added as soon as an upload returns one
+        self.document_ids = []
+        try:
+            started_at = time.perf_counter()
+            with ThreadPoolExecutor(
+                    max_workers=options['clients']) as executor:
+                uploads = list(executor.map(
+                    lambda job: self.run_upload(
+                        target, upload_path, status_path, headers,
+                        chunk_size, *job),
+                    jobs))
+            seconds = time.perf_counter() - started_at
+            sampler.stop()
+
+            report = self.make_report(uploads, seconds, sampler, chunk_size)
+        finally:
+            sampler.stop()
+            if not options['keep_data']:
+                Document.objects.filter(id__in=self.document_ids).delete()
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write(json.dumps(report['summary']))
+        self.stdout.write(f"Report saved to {options['output']}")
+
+    def get_paths(self, target):
+        upload_view, status_view = {
+            'redesign': (views.document_upload_redesign,
+                         views.document_upload_status),
+            'seed': (views.seed_upload_document,
+                     views.seed_upload_document_status),
+        }[target]
+
+        upload_path = self.options['upload_path']
+        status_path = self.options['status_path']
+        try:
+            if not upload_path:
+                upload_path = reverse(upload_view)
+            if not status_path:
+                # A number placeholder keeps the URL pattern valid
+                status_path = reverse(
+                    status_view, args=[self.id_placeholder]).replace(
+                    str(self.id_placeholder), '{id}')
+        except NoReverseMatch:
+            raise CommandError(
+                'Views are not in the URLconf, '
+                'pass --upload-path and --status-path')
+        return upload_path, status_path
+
+    def get_headers(self, target):
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        if target == 'seed':
+            credentials = self.options['seed_credentials']
+            if not credentials:
+                raise CommandError('--seed-credentials is required')
+            token = base64.b64encode(credentials.encode()).decode()
+            headers['Authorization'] = f'Basic {token}'
+            return headers
+
+        # Logged in session of the benchmark user
+        user, created = User.objects.get_or_create(
+            username=self.benchmark_username)
+        if created:
+            UserProfile.objects.get_or_create(
+                user=user, defaults={'alias': user.username})
+
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+
+        csrf_token = uuid.uuid4().hex + uuid.uuid4().hex
+        headers['Cookie'] = (
+            f'{settings.SESSION_COOKIE_NAME}={session.session_key}; '
+            f'{settings.CSRF_COOKIE_NAME}={csrf_token}')
+        headers['X-CSRFToken'] = csrf_token
+        return headers
+
+    def run_upload(self, target, upload_path, status_path, headers,
+                   chunk_size, client_number, upload_number, size):
+        name = f'{self.benchmark_username}-{client_number}-{upload_number}'
+        data = b'%PDF-1.4\n' + os.urandom(max(size - 9, 0))
+        extra_fields = {}
+        if target == 'seed':
+            extra_fields = {'file_name': f'{name}.pdf'}
+
+        client = UploadClient(self.options['url'], headers)
+        document_id, status, error = None, None, None
+        latencies, uploaded_at, stored_at = [], None, None
+        started_at = time.perf_counter()
+        try:
+            latencies, content = client.upload(
+                upload_path, f'{name}.pdf', data, chunk_size, extra_fields)
+            uploaded_at = time.perf_counter()
+
+            response = json.loads(content)
+            if target == 'seed':
+                document_id = response.get('id')
+            else:
+                document_id = (response.get('result') or {}).get(
+                    'document_id')
+            if document_id:
+                self.document_ids.append(document_id)
+
+            while document_id:
+                status = json.loads(client.request(
+                    'GET', status_path.format(id=document_id)))['status']
+                if status != 'pending':
+                    break
+                time.sleep(self.poll_interval)
+            stored_at = time.perf_counter()
+        except Exception as ex:
+            # One failed upload doesn't stop the others
+            error = f'{type(ex).__name__}: {ex}'
+        finally:
+            client.close()
+
+        return {
+            'size': size,
+            'document_id': document_id,
+            'status': status,
+            'error': error,
+            'chunk_latencies': latencies,
+            'row_seconds': (
+                uploaded_at - started_at if uploaded_at is not None else None),
+            'stored_seconds': (
+                stored_at - started_at if stored_at is not None else None),
+        }
+
+    def get_worker_pids(self):
+        if self.options['worker_pids']:
+            return [int(pid) for pid in self.options['worker_pids'].split(',')]
+
+        pids = []
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as cmdline_file:
+                    cmdline = cmdline_file.read()
+            except OSError:
+                continue
+            if (int(pid) != os.getpid()
+                    and (b'gunicorn' in cmdline or b'runserver' in cmdline)):
+                pids.append(int(pid))
+        return pids
+
+    @staticmethod
+    def reset_peak_rss(pid):
+        try:
+            with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_peak_rss_kb(pid):
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def percentiles(values):
+        values = sorted(values)
+        if not values:
+            return {}
+
+        def percentile(q):
+            rank = max(int(round(q / 100 * len(values))), 1)
+            return round(values[rank - 1] * 1000, 3)
+
+        return {
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'mean_ms': round(statistics.mean(values) * 1000, 3),
+        }
+
+    def make_report(self, uploads, seconds, sampler, chunk_size):
+        errors = [upload['error'] for upload in uploads if upload['error']]
+        # Timings of failed uploads are not comparable, they are counted
+        uploads = [upload for upload in uploads if not upload['error']]
+        total_bytes = sum(upload['size'] for upload in uploads)
+        chunk_latencies = [
+            latency
+            for upload in uploads
+            for latency in upload['chunk_latencies']
+        ]
+
+        by_size = {}
+        for size in sorted({upload['size'] for upload in uploads}):
+            size_uploads = [
+                upload for upload in uploads if upload['size'] == size]
+            by_size[size] = {
+                'uploads': len(size_uploads),
+                'row_seconds': self.percentiles(
+                    [upload['row_seconds'] for upload in size_uploads]),
+                'stored_seconds': self.percentiles(
+                    [upload['stored_seconds'] for upload in size_uploads]),
+            }
+
+        summary = {
+            'target': self.options['target'],
+            'clients': self.options['clients'],
+            'uploads': len(uploads),
+            'chunk_size': chunk_size,
+            'seconds': round(seconds, 3),
+            'megabytes_per_second': round(
+                total_bytes / 1024 / 1024 / seconds, 2),
+            'chunk_latency': self.percentiles(chunk_latencies),
+            'peak_temp_disk_bytes': sampler.peak_bytes,
+            'failed': sum(
+                1 for upload in uploads if upload['status'] == 'failed'),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+        }
+        return {
+            'created_at': timezone.now().isoformat(),
+            'summary': summary,
+            'sizes': by_size,
+            'workers_peak_rss_kb': {
+                pid: self.get_peak_rss_kb(pid) for pid in self.worker_pids
+            },
+        }
+
+
+class TempDiskSampler(threading.Thread):
+    """
+    Peak size of files in temporary directories while uploads run
+    """
+
+    def __init__(self, directories, interval=0.1):
+        super().__init__(name='temp-disk-sampler', daemon=True)
+        self.directories = directories
+        self.interval = interval
+        self.peak_bytes = 0
+        # Files that were there before the benchmark are not counted
+        self.initial_bytes = self.get_size()
+        self._stopped = threading.Event()
+
+    def get_size(self):
+        size = 0
+        for directory in self.directories:
+            for root, _, file_names in os.walk(directory):
+                for file_name in file_names:
+                    try:
+                        # Allocated blocks, sparse part files count
+                        # only what was written
+                        size += os.stat(
+                            os.path.join(root, file_name)).st_blocks * 512
+                    except OSError:
+                        pass
+        return size
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak_bytes = max(
+                self.peak_bytes, self.get_size() - self.initial_bytes)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from services.document_weight import DocumentWeightService
+
+
+class Command(BaseCommand):
+    help = 'Calculate weights of published documents for the paywall'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Rescore only documents changed since the last scoring')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes used for the full scoring')
+
+    def handle(self, *args, **options):
+        service = DocumentWeightService()
+
+        if options['incremental']:
+            service.run_incremental()
+        else:
+            service.run(workers=options['workers'])
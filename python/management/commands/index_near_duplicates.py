@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from models import Document
+from services.near_duplicates import NearDuplicateIndex
+
+
+class Command(BaseCommand):
+    help = ('Build the near duplicate index for converted documents '
+            'that are not indexed yet')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Re-index documents that are indexed already')
+
+    def handle(self, *args, **options):
+        documents = Document.objects \
+            .filter(dc_success=True) \
+            .exclude(dc_text='') \
+            .exclude(dc_text__isnull=True) \
+            .order_by('id')
+        if not options['all']:
+            documents = documents.filter(min_hash__isnull=True)
+
+        indexed_count = 0
+        for document in documents.iterator():
+            try:
+                NearDuplicateIndex.index_document(document)
+                indexed_count += 1
+            except Exception as ex:
+                self.stderr.write(f'Document {document.id}: {ex}')
+
+        self.stdout.write(f'Indexed {indexed_count} documents')
@@ -0,0 +1,332 @@
+import datetime
+import itertools
+import json
+import random
+import statistics
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.utils import timezone
+
+import views
+from accounts.models import UserProfile
+from models import (
+    Document, DocumentPaywallSetting, DocumentWeight,
+    DocumentWeightGeneration, Tag
+)
+from school.models import Course
+from services.document_weight import DocumentWeightService
+from services.entitlements import DocumentEntitlements
+from services.membership_cache import MembershipCache
+from services.paywall_threshold import PaywallThresholdCache
+from services.scoring_metrics import QueryCounter, StubMetricsHook
+
+# Replacements of optimized parts, each implementation is compared
+# against the current code. (owner, attribute, replacement)
+IMPLEMENTATIONS = {
+    'current': [],
+    'no-free-set': [
+        (PaywallThresholdCache, '_load_free_documents',
+         staticmethod(lambda setting_id: None)),
+    ],
+    'no-membership-cache': [
+        (MembershipCache, 'get_end_date',
+         staticmethod(MembershipCache.query_end_date)),
+    ],
+    'uncached': [
+        (PaywallThresholdCache, '_load_free_documents',
+         staticmethod(lambda setting_id: None)),
+        (MembershipCache, 'get_end_date',
+         staticmethod(MembershipCache.query_end_date)),
+        # A new version on every call reloads the threshold
+        (PaywallThresholdCache, 'get_version',
+         staticmethod(itertools.count(1).__next__)),
+    ],
+}
+
+# Share of every request type in the load
+SCENARIOS = (
+    ('view', 8),
+    ('comment', 1),
+    ('tag', 1),
+)
+
+
+class Command(BaseCommand):
+    help = ('Load test of document access checks. Seeds users, '
+            'memberships, documents and weights in the local database and '
+            'reports latency and queries per request')
+
+    username_prefix = 'paywall-load'
+    tag_name = 'paywall-load'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=200,
+            help='Number of users')
+        parser.add_argument(
+            '--members-share', type=float, default=0.2,
+            help='Share of users with an active membership')
+        parser.add_argument(
+            '--documents', type=int, default=5000,
+            help='Number of documents')
+        parser.add_argument(
+            '--requests', type=int, default=5000,
+            help='Number of requests for every implementation')
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='Number of concurrent clients')
+        parser.add_argument(
+            '--implementations', default='current',
+            help='Comma separated implementations to compare: '
+                 + ', '.join(IMPLEMENTATIONS))
+        parser.add_argument(
+            '--output', default='document_paywall_load_test.json',
+            help='Path of the JSON report')
+        parser.add_argument(
+            '--keep-data', action='store_true',
+            help="Don't remove synthetic data after the test")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError('The load test writes synthetic data, '
+                               'run it against a local database only')
+
+        implementations = options['implementations'].split(',')
+        unknown = set(implementations) - set(IMPLEMENTATIONS)
+        if unknown:
+            raise CommandError(
+                f"Unknown implementations: {', '.join(sorted(unknown))}")
+
+        results = []
+        started_at = timezone.now()
+        try:
+            users = self.seed_users(
+                options['users'], options['members_share'])
+            document_ids = self.seed_documents(users, options['documents'])
+
+            for implementation in implementations:
+                result = self.load_test(
+                    implementation, users, document_ids,
+                    options['requests'], options['concurrency'])
+                results.append(result)
+                self.stdout.write(json.dumps(result))
+        finally:
+            if not options['keep_data']:
+                self.remove_data(started_at)
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'users': options['users'],
+            'members_share': options['members_share'],
+            'documents': options['documents'],
+            'concurrency': options['concurrency'],
+            'results': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write(f"Report saved to {options['output']}")
+
+    def seed_users(self, users_count, members_share):
+        """
+        Users with profiles, members_share of them with a membership
+        """
+        relation = MembershipCache.get_membership_relation()
+        membership_model = relation.related_model
+        end_date = timezone.now() + datetime.timedelta(days=30)
+
+        users = []
+        for number in range(users_count):
+            user, created = User.objects.get_or_create(
+                username=f'{self.username_prefix}-{number}')
+            if created:
+                UserProfile.objects.get_or_create(
+                    user=user, defaults={'alias': user.username})
+                if random.random() < members_share:
+                    membership_model.objects.create(
+                        **{relation.field.name: user, 'end_date': end_date})
+            users.append(user)
+        return users
+
+    def seed_documents(self, users, documents_count):
+        """
+        Published documents, some of them uploaded by the users and
+        some in existing courses, scored into a new paywall setting
+        """
+        course_ids = list(Course.objects.values_list('id', flat=True)[:50])
+        now = timezone.now()
+
+        documents = []
+        for number in range(documents_count):
+            documents.append(Document(
+                title=f'{self.username_prefix}-{number}',
+                slug=f'{self.username_prefix}-{number}',
+                document=f'raw/{self.username_prefix}-{number}.pdf',
+                notetaker=random.choice(users),
+                course_id=random.choice(course_ids + [None]),
+                status=Document.PUBLISHED,
+                dc_success=True,
+                views=random.randint(0, 10000),
+                publish_date=now - datetime.timedelta(
+                    days=random.randint(0, 1500)),
+                likes_count=random.randint(0, 10),
+                dislikes_count=random.randint(0, 5),
+            ))
+        documents = Document.objects.bulk_create(documents, batch_size=1000)
+
+        DocumentWeightService(metrics_hooks=[StubMetricsHook()]).run(
+            collect_garbage=False)
+        return [document.id for document in documents]
+
+    def remove_data(self, started_at):
+        """
+        Remove synthetic data and the paywall setting scored for it,
+        the generation that was active before the test becomes active
+        again
+        """
+        paywall_settings = DocumentPaywallSetting.objects.filter(
+            created_at__gte=started_at)
+
+        # The previous generation is the last activated one again
+        DocumentWeightGeneration.objects \
+            .filter(paywall_setting__in=paywall_settings) \
+            .update(activated_at=None)
+        PaywallThresholdCache.invalidate()
+
+        DocumentWeight.objects \
+            .filter(document_paywall_setting__in=paywall_settings) \
+            .delete()
+        paywall_settings.delete()
+
+        users = User.objects.filter(
+            username__startswith=f'{self.username_prefix}-')
+        Document.objects.filter(notetaker__in=users).delete()
+        Tag.objects.filter(name=self.tag_name).delete()
+        users.delete()
+
+    def reset_caches(self, users):
+        PaywallThresholdCache._state = None
+        cache.delete_many(
+            [MembershipCache.get_key(user.pk) for user in users])
+
+    def make_request(self, scenario, user, document_id):
+        factory = RequestFactory()
+        if scenario == 'view':
+            request = factory.get(f'/document/{document_id}/')
+        elif scenario == 'comment':
+            request = factory.post(
+                f'/document/{document_id}/comment/',
+                {'content': 'Load test comment'})
+        else:
+            request = factory.post(
+                f'/document/{document_id}/tags/', {'tags': self.tag_name})
+        request.user = user
+        return request
+
+    @staticmethod
+    def view_document(request, document_id):
+        """
+        Access check of the document page
+        """
+        document = Document.objects.get(id=document_id)
+        entitlements = DocumentEntitlements.for_request(request)
+        return document.access_allowed(request.user, entitlements)
+
+    def send_request(self, scenario, user, document_id):
+        """
+        :return (scenario, seconds, queries, error)
+        """
+        request = self.make_request(scenario, user, document_id)
+        query_counter = QueryCounter()
+        error = None
+
+        start_time = time.perf_counter()
+        try:
+            with connection.execute_wrapper(query_counter):
+                if scenario == 'view':
+                    self.view_document(request, document_id)
+                elif scenario == 'comment':
+                    views.add_comment(request, document_id)
+                else:
+                    views.add_tags(request, document_id)
+        except Exception as ex:
+            error = f'{type(ex).__name__}: {ex}'
+        seconds = time.perf_counter() - start_time
+
+        return scenario, seconds, query_counter.count, error
+
+    def load_test(self, implementation, users, document_ids,
+                  requests_count, concurrency):
+        self.reset_caches(users)
+        scenarios, scenario_weights = zip(*SCENARIOS)
+        load = [
+            (random.choices(scenarios, scenario_weights)[0],
+             random.choice(users),
+             random.choice(document_ids))
+            for _ in range(requests_count)
+        ]
+
+        with ExitStack() as stack:
+            for owner, attribute, replacement in \
+                    IMPLEMENTATIONS[implementation]:
+                stack.enter_context(
+                    mock.patch.object(owner, attribute, replacement))
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                responses = list(executor.map(
+                    lambda args: self.send_request(*args), load))
+            seconds = time.perf_counter() - start_time
+
+        result = {
+            'implementation': implementation,
+            'requests': requests_count,
+            'seconds': round(seconds, 3),
+            'requests_per_second': round(requests_count / seconds, 1),
+            'all': self.get_stats(responses),
+        }
+        for scenario in scenarios:
+            result[scenario] = self.get_stats([
+                response for response in responses
+                if response[0] == scenario
+            ])
+        return result
+
+    @staticmethod
+    def percentile(sorted_values, q):
+        """
+        Nearest rank percentile, q is in [0, 100]
+        """
+        if not sorted_values:
+            return None
+        rank = max(int(round(q / 100 * len(sorted_values))), 1)
+        return sorted_values[rank - 1]
+
+    def get_stats(self, responses):
+        latencies = sorted(seconds * 1000 for _, seconds, _, _ in responses)
+        queries = [queries for _, _, queries, _ in responses]
+        errors = [error for _, _, _, error in responses if error]
+
+        def milliseconds(value):
+            return round(value, 3) if value is not None else None
+
+        return {
+            'requests': len(responses),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'p50_ms': milliseconds(self.percentile(latencies, 50)),
+            'p95_ms': milliseconds(self.percentile(latencies, 95)),
+            'p99_ms': milliseconds(self.percentile(latencies, 99)),
+            'queries_per_request': (
+                round(statistics.mean(queries), 2) if queries else None),
+            'max_queries': max(queries) if queries else None,
+        }
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from models import Document, LikesBookmarks
+
+
+class Command(BaseCommand):
+    help = 'Recalculate likes_count and dislikes_count of documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help='Number of document ids updated by one query')
+
+    @staticmethod
+    def count_subquery(**filters):
+        bookmarks = LikesBookmarks.objects \
+            .filter(document=OuterRef('pk'), **filters) \
+            .order_by() \
+            .values('document') \
+            .annotate(count=Count('id')) \
+            .values('count')
+        return Coalesce(
+            Subquery(bookmarks, output_field=IntegerField()), 0)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        id_max = Document.objects.aggregate(Max('id'))['id__max'] or 0
+
+        updated_count = 0
+        for id_from in range(0, id_max + 1, chunk_size):
+            updated_count += Document.objects \
+                .filter(id__gte=id_from, id__lt=id_from + chunk_size) \
+                .update(likes_count=self.count_subquery(like=True),
+                        dislikes_count=self.count_subquery(dislike=True))
+
+        self.stdout.write(f"Updated counters of {updated_count} documents")
@@ -1,4 +1,6 @@
 import datetime
+import hashlib
+import logging
 import os
 import random
 import string
@@ -6,14 +8,18 @@ import traceback
 import slugify
 
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
 from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.urls import reverse
 from sorl.thumbnail import ImageField
 from tinymce.models import HTMLField
 
 from models import DocumentPaywallSetting, DocumentWeight
 
+logger = logging.getLogger('import')
+
 
 class Document(models.Model):
     NOTE = '1'
@@ -121,6 +127,10 @@ class Document(models.Model):
     pages = models.PositiveIntegerField(default=0)
     preview_pages = models.CharField(max_length=200, null=True, blank=True)
     views = models.PositiveIntegerField(default=0)
+    # Maintained by LikesBookmarks signals,
+    # fixed by repair_document_like_counters command
+    likes_count = models.PositiveIntegerField(default=0)
+    dislikes_count = models.PositiveIntegerField(default=0)
     notetaker = models.ForeignKey(
         'auth.User', on_delete=models.CASCADE,
         related_name="uploaded_documents", null=True)
@@ -142,7 +152,8 @@ class Document(models.Model):
     user_professor = models.CharField(
         max_length=200, verbose_name='User Professor Name', blank=True)
 
-    md5 = models.CharField(max_length=32, default='')
+    # Content hash, uploads with the same content share stored files
+    md5 = models.CharField(max_length=32, default='', db_index=True)
 
     slug = models.SlugField(
         verbose_name='slug', max_length=255, default='', editable=False)
@@ -190,36 +201,162 @@ class Document(models.Model):
         slug = self.title
         return slugify.slugify(slug).lower()
 
-    def access_allowed(self, user):
-        try:
-            now = timezone.now()
-            profile = user.profile if user and user.is_authenticated else None
-            is_essays_access_enable = profile and profile.has_essays_access
+    # Stored file and conversion results shared by documents
+    # with the same content
+    STORED_FILE_FIELDS = (
+        'document', 'document_preview', 'dc_pdf_full', 'dc_pdf_preview',
+        'dc_thumbnail', 'dc_text', 'dc_success', 'thumb', 'pages',
+        'preview_pages', 'full_id', 'preview_id',
+    )
 
-            # Allow access if user uploaded this document
-            if profile and profile.documents.filter(id=self.id).exists():
-                return True
+    @staticmethod
+    def get_file_md5(file_obj, block_size=1 << 20):
+        """
+        md5 of the whole file, the file position is kept
+        """
+        position = file_obj.tell()
+        file_obj.seek(0)
+        md5 = hashlib.md5()
+        for block in iter(lambda: file_obj.read(block_size), b''):
+            md5.update(block)
+        file_obj.seek(position)
+        return md5.hexdigest()
+
+    @classmethod
+    def find_stored_duplicate(cls, md5):
+        """
+        Successfully converted document with the same content or None
+        """
+        if not md5:
+            return None
 
-            # Allow access if user uploaded this course
-            if (self.course and profile
-                    and profile.courses.filter(id=self.course_id).exists()):
-                return True
+        return cls.objects \
+            .filter(md5=md5, dc_success=True) \
+            .exclude(document='') \
+            .order_by('id') \
+            .first()
 
-            # Allow access if the user has membership
-            if user.membership_set.filter(end_date__gte=now).exists():
-                return True
+    def link_stored_file(self, original):
+        """
+        Use the stored file and conversion results of original
+        instead of uploading and converting the same content again.
+        The files are shared from now on: delete them with
+        delete_stored_files() and call unlink_stored_file() before
+        converting the document again
+        """
+        for field_name in self.STORED_FILE_FIELDS:
+            setattr(self, field_name, getattr(original, field_name))
+        self.md5 = original.md5
+
+    @classmethod
+    def get_stored_file_field_names(cls):
+        return [
+            field_name for field_name in cls.STORED_FILE_FIELDS
+            if isinstance(cls._meta.get_field(field_name), models.FileField)
+        ]
+
+    def get_shared_file_names(self) -> set:
+        """
+        Names of stored files of the document that other documents use.
+        Files are shared by linking, so only documents with the same
+        content are checked
+        """
+        field_names = self.get_stored_file_field_names()
+        names = {
+            getattr(self, field_name).name for field_name in field_names
+            if getattr(self, field_name)
+        }
+        if not names or not self.md5:
+            return set()
+
+        other_names = Document.objects \
+            .filter(md5=self.md5) \
+            .exclude(id=self.id) \
+            .values_list(*field_names)
+        return names.intersection(
+            name for row in other_names for name in row)
+
+    def delete_stored_files(self):
+        """
+        Delete the stored file and conversion results of the document,
+        files that other documents use are kept
+        """
+        shared_names = self.get_shared_file_names()
+        for field_name in self.get_stored_file_field_names():
+            field_file = getattr(self, field_name)
+            if field_file and field_file.name not in shared_names:
+                field_file.delete(save=False)
+
+    def unlink_stored_file(self) -> bool:
+        """
+        Stop using conversion results shared with other documents, so
+        that converting the document again writes new files instead of
+        overwriting theirs. The uploaded file stays shared, conversion
+        only reads it.
+        :return: True when the document has to be saved
+        """
+        shared_names = self.get_shared_file_names()
+        if not shared_names:
+            return False
+
+        for field_name in self.STORED_FILE_FIELDS:
+            if field_name != 'document':
+                setattr(self, field_name,
+                        self._meta.get_field(field_name).get_default())
+        return True
+
+    def has_entitlement(self, entitlements):
+        """
+        Check access that doesn't depend on the document weight
+        :param entitlements: DocumentEntitlements of the user
+        """
+        # Allow access if user uploaded this document
+        if self.id in entitlements.document_ids:
+            return True
+
+        # Allow access if user uploaded this course
+        if self.course_id and self.course_id in entitlements.course_ids:
+            return True
+
+        # Allow access if the user has membership
+        if entitlements.has_membership:
+            return True
+
+        # Allow access if
+        # the document is an essay
+        # and the user has essay access
+        if self.d_type == self.ESSAY and entitlements.has_essays_access:
+            return True
+
+        return False
+
+    def access_allowed(self, user, entitlements=None):
+        """
+        Check if user can see the full document
+        :param entitlements: DocumentEntitlements of the user,
+        pass DocumentEntitlements.for_request(request) to answer
+        repeated checks of a request without queries about the user
+        """
+        from services.entitlements import DocumentEntitlements
+        from services.paywall_threshold import PaywallThresholdCache
+
+        try:
+            if entitlements is None:
+                entitlements = DocumentEntitlements(user)
 
-            # Allow access if
-            # the document is an essay
-            # and the user has essay access
-            if self.d_type == self.ESSAY and is_essays_access_enable:
+            if self.has_entitlement(entitlements):
                 return True
 
-            setting = DocumentPaywallSetting.objects.latest('created_at')
-            max_weight_for_free_access = (setting.weight_avg * (
-                    setting.weight_avg_percentage / 100))
+            setting_id, max_weight_for_free_access = \
+                PaywallThresholdCache.get()
+
+            # Allow access if the document has free access
+            free_documents = PaywallThresholdCache.get_free_documents()
+            if free_documents is not None:
+                return self.id in free_documents
 
-            document_weight = DocumentWeight.objects.get(document_id=self.id)
+            document_weight = DocumentWeight.objects.get(
+                document_id=self.id, document_paywall_setting_id=setting_id)
 
             # Allow access if the document has free access
             if document_weight.weight <= max_weight_for_free_access:
@@ -236,7 +373,297 @@ class Document(models.Model):
             print(traceback.format_exc())
             return False
 
+    @classmethod
+    def access_allowed_many(cls, user, documents, entitlements=None):
+        """
+        Same check as access_allowed for many documents with a fixed
+        number of queries
+        :return {document id: access allowed}
+        """
+        from services.entitlements import DocumentEntitlements
+        from services.paywall_threshold import PaywallThresholdCache
+
+        documents = list(documents)
+        result = {document.id: False for document in documents}
+        try:
+            if entitlements is None:
+                entitlements = DocumentEntitlements(user)
+
+            paywalled_ids = []
+            for document in documents:
+                if document.has_entitlement(entitlements):
+                    result[document.id] = True
+                else:
+                    paywalled_ids.append(document.id)
+
+            if not paywalled_ids:
+                return result
+
+            setting_id, max_weight_for_free_access = \
+                PaywallThresholdCache.get()
+
+            free_documents = PaywallThresholdCache.get_free_documents()
+            if free_documents is not None:
+                for document_id in paywalled_ids:
+                    result[document_id] = document_id in free_documents
+                return result
+
+            # Documents without weight were not scored and stay closed
+            document_weights = DocumentWeight.objects \
+                .filter(document_id__in=paywalled_ids,
+                        document_paywall_setting_id=setting_id) \
+                .values_list('document_id', 'weight')
+            for document_id, weight in document_weights:
+                # Allow access if the document has free access
+                result[document_id] = weight <= max_weight_for_free_access
+
+            return result
+        except DocumentPaywallSetting.DoesNotExist:
+            # Documents were not scored
+            return result
+        except Exception:
+            logger.exception("Failed to check access to documents")
+            return {document.id: False for document in documents}
+
     class Meta:
         permissions = (
             ('download', 'Can download document'),
         )
+
+
+class DocumentWeightGeneration(models.Model):
+    """
+    Set of document weights scored for one paywall setting.
+    Scoring fills a new generation while readers keep using the active one,
+    the new generation becomes active when scoring finishes
+    """
+    paywall_setting = models.OneToOneField(
+        'document.DocumentPaywallSetting', on_delete=models.CASCADE,
+        related_name='generation')
+    created_at = models.DateTimeField(auto_now_add=True)
+    activated_at = models.DateTimeField(null=True, db_index=True)
+
+    # Serialized KLLSketch of weights built during scoring
+    weight_sketch = models.TextField(blank=True, default='')
+    # When set, documents with weight up to this percentile are free
+    # instead of the weight_avg_percentage rule of the setting.
+    # Use DocumentWeightService.set_free_access_percentile() to change it
+    free_access_percentile = models.FloatField(null=True, blank=True)
+    free_access_weight = models.FloatField(null=True, blank=True)
+
+    # JSON summary of ScoringMetrics of the run that built the generation
+    metrics = models.TextField(blank=True, default='')
+
+    # Compressed DocumentIdBitmap of documents with free access and
+    # the max weight for free access it was built with.
+    # Published by DocumentWeightService.publish_free_documents() when
+    # a full scoring activates the generation, the percentile changes or
+    # the active setting is edited, incremental scoring patches
+    # the rescored documents in
+    free_documents = models.BinaryField(null=True, blank=True)
+    free_documents_weight = models.FloatField(null=True, blank=True)
+
+    @classmethod
+    def get_active_paywall_setting(cls):
+        """
+        Paywall setting of the last activated generation.
+        Settings created before generations were introduced have no
+        generation and are treated as active
+        """
+        try:
+            generation = cls.objects \
+                .filter(activated_at__isnull=False) \
+                .select_related('paywall_setting') \
+                .defer('free_documents') \
+                .latest('activated_at')
+        except cls.DoesNotExist:
+            return DocumentPaywallSetting.objects \
+                .filter(generation__isnull=True) \
+                .latest('created_at')
+
+        return generation.paywall_setting
+
+    @staticmethod
+    def get_max_weight_for_free_access(setting):
+        generation = getattr(setting, 'generation', None)
+        if (generation is not None
+                and generation.free_access_weight is not None):
+            return generation.free_access_weight
+
+        return setting.weight_avg * (setting.weight_avg_percentage / 100)
+
+    def activate(self):
+        self.activated_at = timezone.now()
+        self.save(update_fields=['activated_at'])
+
+
+class DirtyDocument(models.Model):
+    """
+    Documents whose weight inputs (views, likes, status) changed since
+    the last scoring. Consumed by incremental scoring.
+    Code that changes views with queryset.update() has to call
+    DirtyDocument.mark() itself because no signals are sent
+    """
+    # No constraint: a mark may outlive the document it points to
+    document = models.ForeignKey(
+        Document, on_delete=models.DO_NOTHING, db_constraint=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def mark(cls, document_ids):
+        cls.objects.bulk_create(
+            [cls(document_id=document_id) for document_id in document_ids])
+
+
+class QueuedConversion(models.Model):
+    """
+    Documents queued for conversion by
+    services.conversion_scheduler.ConversionScheduler, removed when
+    the conversion is finished. Conversions lost with a restarted worker
+    are queued again from it in their lane
+    """
+    document = models.OneToOneField(
+        Document, on_delete=models.CASCADE, related_name='queued_conversion')
+    lane = models.CharField(max_length=20)
+    queued_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+class DocumentMinHash(models.Model):
+    """
+    MinHash signature of converted document text,
+    maintained by services.near_duplicates.NearDuplicateIndex
+    """
+    document = models.OneToOneField(
+        Document, on_delete=models.CASCADE, related_name='min_hash')
+    # array('Q') of the signature
+    signature = models.BinaryField()
+    # Text file the signature was built from
+    dc_text = models.CharField(max_length=700, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class DocumentLshBucket(models.Model):
+    """
+    LSH band buckets of DocumentMinHash signature, documents sharing
+    a bucket are near duplicate candidates
+    """
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name='lsh_buckets')
+    bucket = models.BigIntegerField(db_index=True)
+
+
+@receiver(post_save, sender=Document)
+def mark_saved_document_dirty(sender, instance, **kwargs):
+    DirtyDocument.mark([instance.id])
+
+
+@receiver(post_save, sender=Document)
+def index_converted_document(sender, instance, **kwargs):
+    from services.near_duplicates import NearDuplicateIndex
+
+    if not (instance.dc_success and instance.dc_text):
+        return
+
+    is_indexed = DocumentMinHash.objects \
+        .filter(document_id=instance.id, dc_text=instance.dc_text.name) \
+        .exists()
+    if not is_indexed:
+        document_id = instance.id
+        transaction.on_commit(
+            lambda: NearDuplicateIndex.index_document_in_background(
+                document_id))
+
+
+@receiver(post_save, sender='document.LikesBookmarks')
+@receiver(post_delete, sender='document.LikesBookmarks')
+def mark_liked_document_dirty(sender, instance, **kwargs):
+    DirtyDocument.mark([instance.document_id])
+
+
+@receiver(pre_save, sender='document.LikesBookmarks')
+def remember_previous_like_state(sender, instance, using, **kwargs):
+    # The counter UPDATE runs in post_save, in autocommit it is committed
+    # separately from the bookmark and concurrent saves of the same
+    # bookmark may count it twice. Deletes are atomic already.
+    # repair_document_like_counters fixes counters of such saves
+    is_atomic = transaction.get_connection(using).in_atomic_block
+    if not is_atomic:
+        logger.warning(
+            f"LikesBookmarks {instance.pk} of document "
+            f"{instance.document_id} is saved outside transaction.atomic(), "
+            f"like counters may drift")
+
+    previous_state = None
+    if instance.pk:
+        bookmarks = sender.objects.using(using).filter(pk=instance.pk)
+        if is_atomic:
+            bookmarks = bookmarks.select_for_update()
+        previous_state = bookmarks \
+            .values_list('document_id', 'like', 'dislike') \
+            .first()
+    instance._previous_like_state = previous_state
+
+
+def _update_like_counters(document_id, likes_delta, dislikes_delta):
+    if likes_delta or dislikes_delta:
+        Document.objects.filter(id=document_id).update(
+            likes_count=F('likes_count') + likes_delta,
+            dislikes_count=F('dislikes_count') + dislikes_delta)
+
+
+@receiver(post_save, sender='document.LikesBookmarks')
+def update_like_counters_on_save(sender, instance, **kwargs):
+    previous_state = getattr(instance, '_previous_like_state', None)
+    if previous_state is not None:
+        document_id, like, dislike = previous_state
+        _update_like_counters(document_id, -int(like), -int(dislike))
+
+    _update_like_counters(
+        instance.document_id, int(instance.like), int(instance.dislike))
+
+
+@receiver(post_delete, sender='document.LikesBookmarks')
+def update_like_counters_on_delete(sender, instance, **kwargs):
+    _update_like_counters(
+        instance.document_id, -int(instance.like), -int(instance.dislike))
+
+
+def invalidate_membership_cache(sender, instance, **kwargs):
+    """
+    Connected to the membership model by DocumentConfig.ready()
+    """
+    from services.membership_cache import MembershipCache
+
+    MembershipCache.invalidate(instance)
+
+
+@receiver(post_save, sender='school.School')
+@receiver(post_delete, sender='school.School')
+@receiver(post_save, sender='school.CourseStructure')
+@receiver(post_delete, sender='school.CourseStructure')
+def invalidate_school_course_index(sender, **kwargs):
+    from services.school_course_index import SchoolCourseIndex
+
+    SchoolCourseIndex.invalidate()
+
+
+@receiver(post_save, sender='document.DocumentPaywallSetting')
+def refresh_free_documents(sender, instance, created, update_fields,
+                           **kwargs):
+    from services.document_weight import DocumentWeightService
+
+    # Scoring saves its statistics with update_fields, the published set
+    # keeps its threshold until the next full scoring
+    if created or (update_fields is not None
+                   and 'weight_avg_percentage' not in update_fields):
+        return
+
+    DocumentWeightService.refresh_free_documents(instance)
+
+
+@receiver(post_save, sender='document.DocumentPaywallSetting')
+@receiver(post_save, sender=DocumentWeightGeneration)
+def invalidate_paywall_threshold(sender, **kwargs):
+    from services.paywall_threshold import PaywallThresholdCache
+
+    PaywallThresholdCache.invalidate()
@@ -0,0 +1,346 @@
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from typing import Dict, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from models import Document, QueuedConversion
+
+logger = logging.getLogger('import')
+
+
+class ConversionEntry(NamedTuple):
+    lane: str
+    rank: int
+    seq: int
+    attempts: int
+
+
+class ConversionScheduler:
+    """
+    Process-local document conversion queue with a fixed number of worker
+    threads.
+    Ranked up documents are converted first, the rest is shared between
+    lanes by weight (DOCUMENT_CONVERSION_SHARES), so a big seed batch
+    doesn't hold back documents of moderators and users.
+    A conversion that ends with dc_success=False is retried with
+    exponential backoff.
+    Rank-ups are published in the Django cache, so a rank-up made by any
+    process reaches the process that queued the document.
+    The queue lives in memory of the process, queued documents are also
+    marked with QueuedConversion. When a scheduler starts it queues
+    documents whose mark is older than recovery_delay again, their
+    conversion was lost with a restarted worker. A document is claimed
+    in the Django cache while it is converted and converted documents
+    are skipped, so a document queued by two processes is converted once
+    """
+    ADMIN = 'admin'
+    UPLOAD = 'upload'
+    SEED = 'seed'
+
+    default_shares = {ADMIN: 4, UPLOAD: 2, SEED: 1}
+    max_attempts = 4
+    retry_delay = 30
+    rank_up_seq_key = 'document_conversion_rank_up_seq'
+    rank_up_key = 'document_conversion_rank_up:{}'
+    rank_up_timeout = 24 * 60 * 60
+    recovery_key = 'document_conversion_recovery'
+    recovery_delay = 15 * 60
+    recovery_limit = 10000
+    claim_key = 'document_conversion_claim:{}'
+    claim_timeout = 60 * 60
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, workers: int = None, shares: Dict[str, int] = None):
+        self.workers = workers or getattr(
+            settings, 'DOCUMENT_CONVERSION_WORKERS', 2)
+        self.shares = shares or getattr(
+            settings, 'DOCUMENT_CONVERSION_SHARES', self.default_shares)
+
+        self._condition = threading.Condition()
+        self._seq = itertools.count()
+        # Queued documents, heap items that don't match are stale
+        self._entries: Dict[int, ConversionEntry] = {}
+        self._ranked = []
+        self._lanes = {lane: [] for lane in self.shares}
+        # Smooth weighted round robin state of lanes
+        self._credits = {lane: 0 for lane in self.shares}
+        # (ready at, seq, document id, lane, attempts) of retries
+        self._delayed = []
+        self._rank_up_seq = None
+        self._threads = []
+
+    @classmethod
+    def get(cls) -> 'ConversionScheduler':
+        # Started on first use, after the server forked its workers
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def submit(cls, document_ids, lane=UPLOAD):
+        """
+        Queue conversion of documents after the current transaction
+        is committed
+        """
+        document_ids = list(document_ids)
+        QueuedConversion.objects.bulk_create(
+            [QueuedConversion(document_id=document_id, lane=lane)
+             for document_id in document_ids],
+            ignore_conflicts=True)
+        transaction.on_commit(
+            lambda: cls.get().enqueue(document_ids, lane))
+
+    @classmethod
+    def get_upload_lane(cls, user) -> str:
+        """
+        Lane of documents uploaded by user, moderators get the admin one
+        """
+        return cls.ADMIN if user.is_staff else cls.UPLOAD
+
+    @classmethod
+    def rank_up(cls, document_id, rank=1):
+        """
+        Convert the document before not ranked documents
+        in whatever process it is queued
+        """
+        try:
+            seq = cache.incr(cls.rank_up_seq_key)
+        except ValueError:
+            cache.add(cls.rank_up_seq_key, 0, timeout=None)
+            seq = cache.incr(cls.rank_up_seq_key)
+        cache.set(
+            cls.rank_up_key.format(seq), (int(document_id), rank),
+            timeout=cls.rank_up_timeout)
+
+        if cls._instance is not None:
+            cls._instance.apply_rank_ups()
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, args=(number == 0,),
+                name=f'document-conversion-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def recover(self):
+        """
+        Queue documents in their lane again when they were queued
+        recovery_delay ago and are still not converted.
+        Documents that were never queued for conversion are left alone.
+        One process recovers per recovery_delay
+        """
+        if not cache.add(self.recovery_key, os.getpid(),
+                         timeout=self.recovery_delay):
+            return
+
+        now = timezone.now()
+        queued_before = now - datetime.timedelta(seconds=self.recovery_delay)
+        queued = list(
+            QueuedConversion.objects
+            .filter(queued_at__lt=queued_before)
+            .order_by('queued_at')
+            .values_list('id', 'document_id', 'lane')[:self.recovery_limit])
+        if not queued:
+            return
+
+        # Recovered again only if they are lost once more
+        QueuedConversion.objects \
+            .filter(id__in=[item[0] for item in queued]) \
+            .update(queued_at=now)
+
+        lanes = defaultdict(list)
+        for _, document_id, lane in queued:
+            lanes[lane if lane in self.shares else self.UPLOAD].append(
+                document_id)
+        for lane, document_ids in lanes.items():
+            logger.info(
+                f"Queued {len(document_ids)} lost conversions again "
+                f"in {lane} lane")
+            self.enqueue(document_ids, lane)
+
+    def enqueue(self, document_ids, lane, attempts=0):
+        with self._condition:
+            for document_id in document_ids:
+                if document_id in self._entries:
+                    continue
+                self._push(document_id, lane, 0, attempts)
+            self._condition.notify_all()
+
+    def _push(self, document_id, lane, rank, attempts):
+        entry = ConversionEntry(lane, rank, next(self._seq), attempts)
+        self._entries[document_id] = entry
+        heap = self._ranked if rank > 0 else self._lanes[lane]
+        heapq.heappush(heap, (-rank, entry.seq, document_id))
+
+    def apply_rank_ups(self):
+        """
+        Move documents ranked up since the last call to the ranked queue
+        """
+        last_seq = cache.get(self.rank_up_seq_key, 0)
+        if self._rank_up_seq is None:
+            # Rank-ups made before this process started are not replayed
+            self._rank_up_seq = last_seq
+            return
+        if last_seq < self._rank_up_seq:
+            # The counter was evicted and started over
+            self._rank_up_seq = 0
+        if last_seq == self._rank_up_seq:
+            return
+
+        keys = [
+            self.rank_up_key.format(seq)
+            for seq in range(self._rank_up_seq + 1, last_seq + 1)
+        ]
+        self._rank_up_seq = last_seq
+        rank_ups = cache.get_many(keys).values()
+
+        with self._condition:
+            for document_id, rank in rank_ups:
+                entry = self._entries.get(document_id)
+                if entry is None or entry.rank >= rank:
+                    continue
+                self._push(document_id, entry.lane, rank, entry.attempts)
+            self._condition.notify_all()
+
+    def _pop_heap(self, heap) -> Optional[int]:
+        while heap:
+            _, seq, document_id = heapq.heappop(heap)
+            entry = self._entries.get(document_id)
+            if entry is not None and entry.seq == seq:
+                return document_id
+        return None
+
+    def _pop_lane(self) -> Optional[int]:
+        """
+        Next document of the lanes by smooth weighted round robin
+        """
+        while True:
+            lanes = [lane for lane, heap in self._lanes.items() if heap]
+            if not lanes:
+                return None
+
+            total = sum(self.shares[lane] for lane in lanes)
+            for lane in lanes:
+                self._credits[lane] += self.shares[lane]
+            lane = max(lanes, key=lambda item: self._credits[item])
+            self._credits[lane] -= total
+
+            document_id = self._pop_heap(self._lanes[lane])
+            if document_id is not None:
+                return document_id
+
+    def _release_delayed(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, document_id, lane, attempts = heapq.heappop(self._delayed)
+            if document_id not in self._entries:
+                self._push(document_id, lane, 0, attempts)
+
+    def _next(self):
+        """
+        Wait for the next document to convert
+        """
+        with self._condition:
+            while True:
+                self._release_delayed()
+                document_id = self._pop_heap(self._ranked)
+                if document_id is None:
+                    document_id = self._pop_lane()
+                if document_id is not None:
+                    return document_id, self._entries.pop(document_id)
+
+                timeout = None
+                if self._delayed:
+                    timeout = max(self._delayed[0][0] - time.monotonic(), 0)
+                self._condition.wait(timeout)
+
+    def _work(self, recover=False):
+        if recover:
+            try:
+                self.recover()
+            except Exception:
+                logger.exception("Failed to recover unconverted documents")
+            finally:
+                connection.close()
+
+        while True:
+            try:
+                self.apply_rank_ups()
+            except Exception:
+                logger.exception("Failed to read conversion rank-ups")
+
+            document_id, entry = self._next()
+            try:
+                self._convert(document_id, entry)
+            finally:
+                # Connection of the worker thread
+                connection.close()
+
+    @staticmethod
+    def finish(document_id):
+        """
+        Remove the queue mark of a converted or given up document
+        """
+        try:
+            QueuedConversion.objects.filter(document_id=document_id).delete()
+        except Exception:
+            # A stale mark only queues the document once more
+            logger.exception(
+                f"Failed to remove queue mark of document {document_id}")
+
+    def _convert(self, document_id, entry):
+        claim_key = self.claim_key.format(document_id)
+        if not cache.add(claim_key, os.getpid(), timeout=self.claim_timeout):
+            # Another process converts the document
+            return
+
+        try:
+            document = Document.objects.get(id=document_id)
+            if document.dc_success:
+                # Converted by another process meanwhile
+                self.finish(document_id)
+                return
+            if document.unlink_stored_file():
+                # Results of a duplicate belong to the original as well
+                document.save(ignore_convert=True)
+            document.convert_document()
+            document.refresh_from_db(fields=['dc_success'])
+            failed = document.dc_success is False
+        except Document.DoesNotExist:
+            return
+        except Exception:
+            logger.exception(f"Failed to convert document {document_id}")
+            failed = True
+        finally:
+            cache.delete(claim_key)
+
+        attempts = entry.attempts + 1
+        if not failed or attempts >= self.max_attempts:
+            self.finish(document_id)
+            return
+
+        # Exponential backoff with jitter
+        delay = self.retry_delay * 2 ** entry.attempts
+        delay *= random.uniform(0.8, 1.2)
+        with self._condition:
+            heapq.heappush(self._delayed, (
+                time.monotonic() + delay, next(self._seq),
+                document_id, entry.lane, attempts))
+            self._condition.notify_all()
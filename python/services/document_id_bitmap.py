@@ -0,0 +1,49 @@
+import zlib
+
+from typing import Iterable
+
+
+class DocumentIdBitmap:
+    """
+    Compact set of document ids, one bit for every id up to the largest.
+    Membership test is O(1) without database access.
+    Stored compressed, runs of closed documents compress well
+    """
+
+    def __init__(self, bits: bytearray = None):
+        self.bits = bits if bits is not None else bytearray()
+
+    @classmethod
+    def from_ids(cls, document_ids: Iterable[int]) -> 'DocumentIdBitmap':
+        bitmap = cls()
+        for document_id in document_ids:
+            bitmap.add(document_id)
+        return bitmap
+
+    def add(self, document_id: int):
+        index = document_id >> 3
+        if index >= len(self.bits):
+            # Grow in big steps, ids mostly come in ascending order
+            self.bits.extend(
+                bytes(max(index + 1 - len(self.bits), len(self.bits))))
+        self.bits[index] |= 1 << (document_id & 7)
+
+    def discard(self, document_id: int):
+        index = document_id >> 3
+        if index < len(self.bits):
+            self.bits[index] &= ~(1 << (document_id & 7)) & 0xff
+
+    def __contains__(self, document_id: int) -> bool:
+        index = document_id >> 3
+        return (index < len(self.bits)
+                and bool(self.bits[index] & (1 << (document_id & 7))))
+
+    def __len__(self) -> int:
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+    def dumps(self) -> bytes:
+        return zlib.compress(bytes(self.bits.rstrip(b'\x00')))
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'DocumentIdBitmap':
+        return cls(bytearray(zlib.decompress(data)))
@@ -1,13 +1,25 @@
+import json
 import logging
+import math
+import threading
 import time
 
 from abc import ABC, abstractmethod
-from typing import Union, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple, Type, Union
 
+from django.db import connection, connections, transaction
 from django.db.models import Avg, Min, Max
 from django.utils import timezone
 
-from models import Document, DocumentWeight, DocumentPaywallSetting
+from services.document_id_bitmap import DocumentIdBitmap
+from services.paywall_threshold import PaywallThresholdCache
+from services.quantile_sketch import KLLSketch
+from services.scoring_metrics import ScoringMetrics, get_default_hooks
+from models import (
+    Document, DocumentWeight, DocumentPaywallSetting, DocumentWeightGeneration,
+    DirtyDocument
+)
 
 logger = logging.getLogger('import')
 
@@ -15,12 +27,20 @@ logger = logging.getLogger('import')
 class BaseRule(ABC):
     """
     Abstract class for weight rules
+    Every rule declares data it reads from a document:
+    fields - Document columns
+    annotations - aggregates computed by the database, {name: expression}
+    Rules get a DocumentScoringRow with exactly these values
     """
+    fields: Tuple[str, ...] = ()
+    annotations: Dict[str, Any] = {}
 
-    def __init__(self, document: Document, weight: float, values: dict):
+    def __init__(self, document: 'DocumentScoringRow', weight: float,
+                 values: dict, now=None):
         self.document = document
         self.weight = weight
         self.values = values
+        self.now = now or timezone.now()
 
     @property
     @abstractmethod
@@ -38,15 +58,80 @@ class BaseRule(ABC):
         pass
 
 
+class RuleRegistry:
+    """
+    Ordered list of weight rules.
+    Collects data declared by rules so that a whole batch of documents
+    is fetched by one query
+    """
+
+    def __init__(self):
+        self._rules = []
+
+    def register(self, rule: Type[BaseRule]) -> Type[BaseRule]:
+        """
+        Add rule to the end of the list, can be used as a class decorator
+        """
+        for name, expression in rule.annotations.items():
+            registered = self.annotations.get(name)
+            if registered is not None and registered != expression:
+                raise ValueError(
+                    f'Annotation "{name}" of rule "{rule.name}" conflicts '
+                    f'with an already registered one')
+
+        self._rules.append(rule)
+        return rule
+
+    @property
+    def rules(self) -> List[Type[BaseRule]]:
+        return list(self._rules)
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        fields = ['id']
+        for rule in self._rules:
+            fields += [field for field in rule.fields if field not in fields]
+        return tuple(fields)
+
+    @property
+    def annotations(self) -> Dict[str, Any]:
+        annotations = {}
+        for rule in self._rules:
+            annotations.update(rule.annotations)
+        return annotations
+
+    def get_values_queryset(self, documents):
+        """
+        Queryset of declared fields and annotations of documents
+        """
+        annotations = self.annotations
+        return documents \
+            .annotate(**annotations) \
+            .values(*self.fields, *annotations)
+
+    def query_budget(self, rows_count: int, chunk_size: int) -> int:
+        """
+        Number of selects that fetch declared data of rows_count documents
+        paginated by chunk_size, the last one finds no more rows.
+        It doesn't depend on the number of rules
+        """
+        return math.ceil(rows_count / chunk_size) + 1
+
+
+rule_registry = RuleRegistry()
+
+
+@rule_registry.register
 class DocumentViewsRatioRule(BaseRule):
     """
     View ratio rule that calculates ratio between published date and views
     by formula: document views / (now - publish date)
     """
     name = "views_ratio"
+    fields = ('views', 'publish_date')
 
     def run(self):
-        time_diff = (timezone.now() - self.document.publish_date).days
+        time_diff = (self.now - self.document.publish_date).days
 
         if time_diff == 0:
             ratio = 0
@@ -56,6 +141,7 @@ class DocumentViewsRatioRule(BaseRule):
         return ratio
 
 
+@rule_registry.register
 class IsAcademicDocumentRule(BaseRule):
     """
     The rule that checks if a document is "academic document"
@@ -63,6 +149,7 @@ class IsAcademicDocumentRule(BaseRule):
     if no then return 0
     """
     name = "academic_document"
+    fields = ('scraping_status', 'course_id')
     __multiplier_percentage = 10
 
     def run(self):
@@ -73,19 +160,20 @@ class IsAcademicDocumentRule(BaseRule):
             return 0
 
 
+@rule_registry.register
 class LikesRatioRule(BaseRule):
     """
     Likes/Dislikes ratio rule
     Formula: Likes / Dislikes
     """
     name = "likes_ratio"
+    fields = ('likes_count', 'dislikes_count')
     __multiplier_percentage = 10
     __domination_percentage = 20
 
     def run(self):
-        likes = self.document.likesbookmarks_set.filter(like=True).count()
-        dislikes = self.document.likesbookmarks_set.filter(
-            dislike=True).count()
+        likes = self.document.likes_count
+        dislikes = self.document.dislikes_count
 
         views_ratio_value = self.values.get(DocumentViewsRatioRule.name, 0)
         domination_percentage = self.__domination_percentage / 100
@@ -103,27 +191,63 @@ class LikesRatioRule(BaseRule):
         return value
 
 
+class DocumentScoringRow:
+    """
+    Prefetched document data passed to weight rules.
+    Holds fields and annotations declared by registered rules
+    """
+
+    def __init__(self, values: dict):
+        self.__dict__.update(values)
+
+    @property
+    def is_academic_document(self):
+        """
+        Same check as Document.is_academic_document
+        """
+        return (self.scraping_status == Document.SKIPPED
+                or not self.course_id)
+
+
 class DocumentWeightCalculator:
     """
     Class represent calculation of all rules
     :return document weight
     """
 
-    def __init__(self, document: Document):
+    def __init__(self, document: DocumentScoringRow, now=None,
+                 registry: RuleRegistry = rule_registry,
+                 metrics: ScoringMetrics = None):
         self.weight = 0
         self.values = dict()
-        self.rules = [
-            DocumentViewsRatioRule,
-            IsAcademicDocumentRule,
-            LikesRatioRule
-        ]
+        self.rules = registry.rules
 
         self.document = document
+        self.now = now
+        self.metrics = metrics
+
+    @classmethod
+    def run_many(cls, rows: List[DocumentScoringRow], now=None,
+                 registry: RuleRegistry = rule_registry,
+                 metrics: ScoringMetrics = None) -> List[float]:
+        """
+        Calculate weights for a whole chunk of prefetched rows
+        """
+        now = now or timezone.now()
+        return [
+            cls(row, now=now, registry=registry, metrics=metrics).run()
+            for row in rows
+        ]
 
     def run(self) -> float:
         for rule in self.rules:
-            rule_instance = rule(self.document, self.weight, self.values)
+            start_time = time.perf_counter()
+            rule_instance = rule(self.document, self.weight, self.values,
+                                 now=self.now)
             rule_value = rule_instance.run()
+            if self.metrics is not None:
+                self.metrics.observe_rule(
+                    rule_instance.name, time.perf_counter() - start_time)
 
             self.values[rule_instance.name] = rule_value
 
@@ -132,36 +256,299 @@ class DocumentWeightCalculator:
         return float(self.weight)
 
 
+class WeightAggregate:
+    """
+    Running min/sum/count/max and quantile sketch of document weights.
+    Lets the paywall setting statistics be updated from a batch of changed
+    weights instead of an aggregate over the whole weight table.
+    The sketch can't forget values, so only aggregates of a full scoring
+    have one and the percentile threshold is kept until the next full
+    scoring
+    """
+
+    def __init__(self, weight_min=None, weight_sum=0.0, count=0,
+                 weight_max=None, with_sketch=True):
+        self.weight_min = weight_min
+        self.weight_sum = weight_sum
+        self.count = count
+        self.weight_max = weight_max
+        self.sketch = KLLSketch() if with_sketch else None
+        # Set when a removed weight could have been the min or the max
+        self.extremes_outdated = False
+
+    @classmethod
+    def from_setting(cls, setting):
+        """
+        Aggregate of the setting statistics for incremental updates
+        """
+        count = setting.documents_count
+        if not count:
+            return cls(with_sketch=False)
+
+        return cls(
+            weight_min=setting.weight_min,
+            weight_sum=setting.weight_avg * count,
+            count=count,
+            weight_max=setting.weight_max,
+            with_sketch=False
+        )
+
+    @property
+    def weight_avg(self):
+        return self.weight_sum / self.count if self.count else None
+
+    def add(self, weight: float):
+        self.weight_sum += weight
+        self.count += 1
+        if self.sketch is not None:
+            self.sketch.update(weight)
+        if self.weight_min is None or weight < self.weight_min:
+            self.weight_min = weight
+        if self.weight_max is None or weight > self.weight_max:
+            self.weight_max = weight
+
+    def remove(self, weight: float):
+        self.weight_sum -= weight
+        self.count -= 1
+        if (self.weight_min is None or weight <= self.weight_min
+                or weight >= self.weight_max):
+            self.extremes_outdated = True
+
+    def merge(self, other: 'WeightAggregate'):
+        self.weight_sum += other.weight_sum
+        self.count += other.count
+        if other.weight_min is not None and (
+                self.weight_min is None or other.weight_min < self.weight_min):
+            self.weight_min = other.weight_min
+        if other.weight_max is not None and (
+                self.weight_max is None or other.weight_max > self.weight_max):
+            self.weight_max = other.weight_max
+        self.extremes_outdated |= other.extremes_outdated
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+
 class DocumentWeightService:
     __chunk_size = 1000
+    __batch_chunk_size = 5000
+    __shards_per_worker = 4
+
+    def __init__(self, metrics_hooks=None):
+        """
+        :param metrics_hooks: receivers of scoring metrics,
+        DOCUMENT_SCORING_METRICS_HOOKS setting by default
+        """
+        if metrics_hooks is None:
+            metrics_hooks = get_default_hooks()
+        self.metrics_hooks = metrics_hooks
 
     @classmethod
-    def make_and_save_aggregation(cls, setting):
+    def make_and_save_aggregation(cls, setting,
+                                  aggregate: WeightAggregate = None):
         """
         Calculate min, avg, max weight values and save it to new setting
+        If aggregate is passed its values are used instead of scanning
+        the weight table. Only min/max are re-read when they are outdated.
+        The sketch of a full scoring aggregate is saved to the setting
+        generation together with the free access weight of its percentile
         """
-        weight_agg = DocumentWeight.objects.aggregate(
-            Min('weight'), Avg('weight'), Max('weight')
-        )
+        weights = DocumentWeight.objects.filter(
+            document_paywall_setting=setting)
+        if aggregate is None:
+            weight_agg = weights.aggregate(
+                Min('weight'), Avg('weight'), Max('weight')
+            )
+            weight_min = weight_agg['weight__min']
+            weight_avg = weight_agg['weight__avg']
+            weight_max = weight_agg['weight__max']
+        else:
+            if aggregate.extremes_outdated:
+                weight_agg = weights.aggregate(Min('weight'), Max('weight'))
+                aggregate.weight_min = weight_agg['weight__min']
+                aggregate.weight_max = weight_agg['weight__max']
+                aggregate.extremes_outdated = False
+
+            weight_min = aggregate.weight_min
+            weight_avg = aggregate.weight_avg
+            weight_max = aggregate.weight_max
+            setting.documents_count = aggregate.count
+
+            generation = getattr(setting, 'generation', None)
+            if generation is not None and aggregate.sketch is not None:
+                cls.save_weight_sketch(generation, aggregate.sketch)
+
+        setting.weight_min = round(weight_min or 0, 5)
+        setting.weight_avg = round(weight_avg or 0, 5)
+        setting.weight_max = round(weight_max or 0, 5)
+
+        # Only the statistics, an admin edit of the setting republishes
+        # the free set (see refresh_free_documents())
+        setting.save(update_fields=[
+            'weight_min', 'weight_avg', 'weight_max', 'documents_count'])
+
+    @classmethod
+    def get_query_budget(cls, documents_count, rescore=False,
+                         registry: RuleRegistry = rule_registry) -> int:
+        """
+        Max number of queries that score documents_count documents,
+        counted from the write path of score_documents_in_batches()
+        or rescore_documents() when rescore=True.
+        Statistics of the setting are not included
+        """
+        chunk_size = cls.__batch_chunk_size
+        if not rescore:
+            # One bulk_create of every chunk of rows
+            return (registry.query_budget(documents_count, chunk_size)
+                    + math.ceil(documents_count / chunk_size))
+
+        queries = 0
+        for start in range(0, documents_count, chunk_size):
+            rows_count = min(chunk_size, documents_count - start)
+            queries += (
+                # Old weights
+                1
+                + registry.query_budget(rows_count, chunk_size)
+                # Weights of documents that are not scored anymore
+                + 1
+                # bulk_update and bulk_create split the rows between them,
+                # each of them writes batches of __chunk_size
+                + math.ceil(rows_count / cls.__chunk_size) + 1
+            )
+        return queries
+
+    @classmethod
+    def publish_free_documents(cls, setting):
+        """
+        Save ids of documents with free access to the setting generation,
+        readers load them once per threshold version.
+        Scans all weights of the setting, so it runs when a full scoring
+        activates the setting, the percentile changes or the setting
+        is edited only
+        """
+        generation = getattr(setting, 'generation', None)
+        if generation is None:
+            return
+
+        max_weight = DocumentWeightGeneration.get_max_weight_for_free_access(
+            setting)
+        free_document_ids = DocumentWeight.objects \
+            .filter(document_paywall_setting=setting,
+                    weight__lte=max_weight) \
+            .values_list('document_id', flat=True) \
+            .iterator(chunk_size=cls.__batch_chunk_size)
+
+        generation.free_documents = DocumentIdBitmap \
+            .from_ids(free_document_ids) \
+            .dumps()
+        generation.free_documents_weight = max_weight
+        generation.save(
+            update_fields=['free_documents', 'free_documents_weight'])
+
+    @classmethod
+    def refresh_free_documents(cls, setting) -> bool:
+        """
+        Publish the free set of the active setting again when its max
+        weight for free access no longer matches the one the set was
+        built with, e.g. after weight_avg_percentage was edited
+        :return: True when the set was published
+        """
+        generation = getattr(setting, 'generation', None)
+        if generation is None or generation.free_documents is None:
+            # Readers compare weights with the setting threshold
+            return False
+
+        max_weight = DocumentWeightGeneration.get_max_weight_for_free_access(
+            setting)
+        if max_weight == generation.free_documents_weight:
+            return False
+
+        active_setting = DocumentWeightGeneration.get_active_paywall_setting()
+        if active_setting.id != setting.id:
+            # Published when scoring activates it
+            return False
+
+        with PaywallThresholdCache.invalidation_batch(), \
+                transaction.atomic():
+            cls.publish_free_documents(setting)
+        return True
+
+    @classmethod
+    def patch_free_documents(cls, setting, changed_weights: Dict[int, Any]):
+        """
+        Update the published free set with rescored documents
+        against the threshold it was built with
+        :param changed_weights: {document id: new weight or None}
+        """
+        generation = getattr(setting, 'generation', None)
+        if (generation is None or generation.free_documents is None
+                or not changed_weights):
+            return
 
-        setting.weight_min = round(weight_agg['weight__min'], 5)
-        setting.weight_avg = round(weight_agg['weight__avg'], 5)
-        setting.weight_max = round(weight_agg['weight__max'], 5)
+        free_documents = DocumentIdBitmap.loads(generation.free_documents)
+        max_weight = generation.free_documents_weight
+        is_changed = False
+        for document_id, weight in changed_weights.items():
+            is_free = weight is not None and weight <= max_weight
+            if is_free != (document_id in free_documents):
+                is_changed = True
+                if is_free:
+                    free_documents.add(document_id)
+                else:
+                    free_documents.discard(document_id)
+
+        if is_changed:
+            generation.free_documents = free_documents.dumps()
+            generation.save(update_fields=['free_documents'])
+
+    @classmethod
+    def save_weight_sketch(cls, generation, sketch: KLLSketch):
+        generation.weight_sketch = sketch.dumps()
+        if generation.free_access_percentile is not None:
+            generation.free_access_weight = sketch.quantile(
+                generation.free_access_percentile / 100)
+        generation.save(
+            update_fields=['weight_sketch', 'free_access_weight'])
 
-        setting.save()
+    @classmethod
+    def set_free_access_percentile(cls, percentile):
+        """
+        Make documents with weight up to percentile free in the active
+        generation and in the following ones.
+        None returns to the weight_avg_percentage rule
+        """
+        with PaywallThresholdCache.invalidation_batch(), \
+                transaction.atomic():
+            setting = DocumentWeightGeneration.get_active_paywall_setting()
+            generation = setting.generation
+            generation.free_access_percentile = percentile
+            generation.free_access_weight = None
+            if percentile is not None and generation.weight_sketch:
+                generation.free_access_weight = KLLSketch \
+                    .loads(generation.weight_sketch) \
+                    .quantile(percentile / 100)
+            generation.save(update_fields=[
+                'free_access_percentile', 'free_access_weight'])
+            cls.publish_free_documents(setting)
 
     @classmethod
     def get_paywall_setting(cls, force_create=False):
         """
-        Get paywall setting
+        Get paywall setting of the active weight generation
         If setting doesn't exist or force_create=True
-        then new setting will be created
+        then new setting will be created.
+        A forced setting starts a new generation that stays inactive
+        until activate_paywall_setting() is called
         """
         is_not_created = False
+        free_access_percentile = None
 
         try:
-            paywall_setting = DocumentPaywallSetting.objects.latest(
-                'created_at')
+            paywall_setting = \
+                DocumentWeightGeneration.get_active_paywall_setting()
+            active_generation = getattr(paywall_setting, 'generation', None)
+            if active_generation is not None:
+                free_access_percentile = \
+                    active_generation.free_access_percentile
         except DocumentPaywallSetting.DoesNotExist:
             is_not_created = True
 
@@ -172,76 +559,394 @@ class DocumentWeightService:
                 weight_max=0,
                 documents_count=0
             )
+            generation = DocumentWeightGeneration.objects.create(
+                paywall_setting=paywall_setting,
+                free_access_percentile=free_access_percentile)
+
+            if is_not_created and not force_create:
+                generation.activate()
 
         return paywall_setting
 
+    @classmethod
+    def activate_paywall_setting(cls, setting,
+                                 aggregate: WeightAggregate = None):
+        """
+        Switch readers to the generation of setting
+        """
+        with transaction.atomic():
+            cls.make_and_save_aggregation(setting, aggregate)
+            cls.publish_free_documents(setting)
+            setting.generation.activate()
+
+    @classmethod
+    def delete_stale_generations(cls):
+        """
+        Remove weights of generations older than the active one.
+        Rows are removed in chunks to keep transactions short
+        """
+        active_setting = DocumentWeightGeneration.get_active_paywall_setting()
+        stale_weights = DocumentWeight.objects.filter(
+            document_paywall_setting__created_at__lt=active_setting.created_at)
+
+        deleted_count = 0
+        while True:
+            weight_ids = list(
+                stale_weights.values_list('id', flat=True)[:cls.__chunk_size])
+            if not weight_ids:
+                break
+
+            DocumentWeight.objects.filter(id__in=weight_ids).delete()
+            deleted_count += len(weight_ids)
+
+        logger.info(f"Removed {deleted_count} stale documents weights")
+
+    @classmethod
+    def delete_stale_generations_in_background(cls) -> threading.Thread:
+        def target():
+            try:
+                cls.delete_stale_generations()
+            except Exception:
+                logger.exception("Failed to remove stale documents weights")
+            finally:
+                connection.close()
+
+        thread = threading.Thread(
+            target=target, name='document-weight-gc')
+        thread.start()
+        return thread
+
     def calculate_documents(self, documents: List[Document]):
         """
         Function that calculates list of documents and update current setting
+        Weights are written by bulk queries and only documents that take
+        part in scoring get a weight
         """
         if len(documents) == 0:
             return
 
         paywall_setting = self.get_paywall_setting()
+        document_ids = sorted({document.id for document in documents})
 
         # Calculate new weight for documents
-        documents_count = 0
-        logger.info("Started scoring documents")
-        start_time = time.time()
-        for document in documents:
-            weight = DocumentWeightCalculator(document).run()
-
-            obj, created = DocumentWeight.objects.update_or_create(
-                document=document,
-                defaults={
-                    'document_paywall_setting': paywall_setting,
-                    'weight': round(weight, 5)
-                }
-            )
+        logger.info(f"Started scoring documents. Query budget - "
+                    f"{self.get_query_budget(len(document_ids), True)}")
+        metrics = ScoringMetrics(self.metrics_hooks)
+        with metrics.track_queries(), \
+                PaywallThresholdCache.invalidation_batch():
+            self.rescore_documents_in_chunks(
+                document_ids, paywall_setting, metrics)
+            metrics.finish()
+
+    @classmethod
+    def get_scored_documents(cls):
+        """
+        Documents that take part in scoring
+        """
+        return Document.objects.filter(
+            dc_success=True,
+            status=Document.PUBLISHED
+        )
 
-            if created:
-                documents_count += 1
-        end_time = time.time()
-        logger.info(f"Finished scoring documents. "
-                    f"Execution time - {end_time - start_time}")
+    @classmethod
+    def iter_scoring_rows(cls, documents, chunk_size=None,
+                          registry: RuleRegistry = rule_registry):
+        """
+        Yield chunks of DocumentScoringRow.
+        Every chunk is fetched by one query paginated by id
+        with the data declared by registered rules
+        """
+        chunk_size = chunk_size or cls.__batch_chunk_size
+        documents = registry.get_values_queryset(documents).order_by('id')
 
-        paywall_setting.documents_count += documents_count
-        self.make_and_save_aggregation(paywall_setting)
+        last_id = 0
+        while True:
+            rows = list(documents.filter(id__gt=last_id)[:chunk_size])
+            if not rows:
+                return
 
-    def run(self):
+            yield [DocumentScoringRow(values) for values in rows]
+            last_id = rows[-1]['id']
+
+    def score_documents_in_batches(self, documents, paywall_setting,
+                                   now=None, metrics: ScoringMetrics = None
+                                   ) -> WeightAggregate:
+        """
+        Score documents chunk by chunk and save weights with bulk_create
+        :return aggregate of saved weights
+        """
+        now = now or timezone.now()
+        aggregate = WeightAggregate()
+        for rows in self.iter_scoring_rows(documents):
+            weights = [
+                round(weight, 5)
+                for weight in DocumentWeightCalculator.run_many(
+                    rows, now=now, metrics=metrics)
+            ]
+
+            DocumentWeight.objects.bulk_create([
+                DocumentWeight(
+                    document_id=row.id,
+                    document_paywall_setting=paywall_setting,
+                    weight=weight
+                )
+                for row, weight in zip(rows, weights)
+            ])
+
+            for weight in weights:
+                aggregate.add(weight)
+
+            if metrics is not None:
+                metrics.finish_batch(len(rows))
+
+        return aggregate
+
+    @classmethod
+    def split_into_shards(cls, documents, shards_count):
+        """
+        Split documents into id ranges [id_from, id_to)
+        """
+        id_range = documents.aggregate(Min('id'), Max('id'))
+        id_min, id_max = id_range['id__min'], id_range['id__max']
+        if id_min is None:
+            return []
+
+        shard_size = (id_max - id_min) // shards_count + 1
+        return [
+            (id_from, min(id_from + shard_size, id_max + 1))
+            for id_from in range(id_min, id_max + 1, shard_size)
+        ]
+
+    def score_documents_in_parallel(self, documents, paywall_setting,
+                                    workers, metrics: ScoringMetrics = None
+                                    ) -> WeightAggregate:
+        """
+        Score id range shards in a process pool.
+        Every worker gets several shards so that a dense id range
+        does not keep one worker busy while the others are idle
+        """
+        now = timezone.now()
+        shards = self.split_into_shards(
+            documents, workers * self.__shards_per_worker)
+
+        # Forked workers must open their own database connections
+        connections.close_all()
+
+        aggregate = WeightAggregate()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _score_shard, paywall_setting.id, id_from, id_to, now)
+                for id_from, id_to in shards
+            ]
+            for future in futures:
+                shard_aggregate, shard_metrics = future.result()
+                aggregate.merge(shard_aggregate)
+                if metrics is not None:
+                    metrics.merge(shard_metrics)
+
+        return aggregate
+
+    def rescore_documents(self, document_ids, paywall_setting,
+                          aggregate: WeightAggregate,
+                          metrics: ScoringMetrics = None,
+                          changed_weights: Dict[int, Any] = None):
+        """
+        Re-calculate weight for given documents and apply the difference
+        between old and new weights to aggregate.
+        Documents that are not scored anymore lose their weight
+        :param changed_weights: collects {document id: new weight or None}
+        """
+        if changed_weights is None:
+            changed_weights = {}
+        old_weights = {
+            document_id: (weight_id, weight)
+            for document_id, weight_id, weight in DocumentWeight.objects
+            .filter(document_id__in=document_ids,
+                    document_paywall_setting=paywall_setting)
+            .values_list('document_id', 'id', 'weight')
+        }
+
+        new_weights, updated_weights = [], []
+        now = timezone.now()
+        documents = self.get_scored_documents().filter(id__in=document_ids)
+        for rows in self.iter_scoring_rows(documents):
+            weights = DocumentWeightCalculator.run_many(
+                rows, now=now, metrics=metrics)
+
+            for row, weight in zip(rows, weights):
+                weight = round(weight, 5)
+                document_weight = DocumentWeight(
+                    document_id=row.id,
+                    document_paywall_setting=paywall_setting,
+                    weight=weight
+                )
+
+                if row.id in old_weights:
+                    weight_id, old_weight = old_weights.pop(row.id)
+                    aggregate.remove(old_weight)
+                    document_weight.id = weight_id
+                    updated_weights.append(document_weight)
+                else:
+                    new_weights.append(document_weight)
+
+                aggregate.add(weight)
+                changed_weights[row.id] = weight
+
+        # Weights that are left belong to unpublished or deleted documents
+        for document_id, (_, weight) in old_weights.items():
+            aggregate.remove(weight)
+            changed_weights[document_id] = None
+        DocumentWeight.objects \
+            .filter(id__in=[
+                weight_id for weight_id, _ in old_weights.values()]) \
+            .delete()
+
+        DocumentWeight.objects.bulk_update(
+            updated_weights, ['weight'],
+            batch_size=self.__chunk_size)
+        DocumentWeight.objects.bulk_create(
+            new_weights, batch_size=self.__chunk_size)
+
+        if metrics is not None:
+            metrics.finish_batch(len(updated_weights) + len(new_weights))
+
+    def rescore_documents_in_chunks(self, document_ids, paywall_setting,
+                                    metrics: ScoringMetrics = None):
+        """
+        Upsert weights of documents chunk by chunk and update statistics
+        of the setting and the published free set from the changed weights
+        only.
+        The setting row is locked so that concurrent calls don't lose
+        each other's statistics
+        """
+        with transaction.atomic():
+            paywall_setting = DocumentPaywallSetting.objects \
+                .select_for_update() \
+                .get(pk=paywall_setting.pk)
+            aggregate = WeightAggregate.from_setting(paywall_setting)
+            changed_weights = {}
+
+            for i in range(0, len(document_ids), self.__batch_chunk_size):
+                self.rescore_documents(
+                    document_ids[i:i + self.__batch_chunk_size],
+                    paywall_setting,
+                    aggregate,
+                    metrics,
+                    changed_weights)
+
+            self.make_and_save_aggregation(paywall_setting, aggregate)
+            self.patch_free_documents(paywall_setting, changed_weights)
+
+    def run_incremental(self):
+        """
+        Re-calculate weight only for documents marked as dirty since
+        the last scoring and update statistics of the current setting.
+        Weights of untouched documents keep aging since views ratio depends
+        on the current date, so the full run() is still needed from time
+        to time to reconcile them
+        """
+        # Marks left in the table were made after the last full run started
+        last_mark = DirtyDocument.objects.order_by('-id').first()
+        if last_mark is None:
+            logger.info("No dirty documents found")
+            return
+
+        document_ids = sorted(set(
+            DirtyDocument.objects
+            .filter(id__lte=last_mark.id)
+            .values_list('document_id', flat=True)
+        ))
+        logger.info(f"Found {len(document_ids)} dirty documents")
+
+        paywall_setting = self.get_paywall_setting()
+
+        logger.info(f"Started incremental scoring documents. Query budget - "
+                    f"{self.get_query_budget(len(document_ids), True)}")
+        metrics = ScoringMetrics(self.metrics_hooks)
+        with metrics.track_queries(), \
+                PaywallThresholdCache.invalidation_batch():
+            with transaction.atomic():
+                self.rescore_documents_in_chunks(
+                    document_ids, paywall_setting, metrics)
+                DirtyDocument.objects.filter(id__lte=last_mark.id).delete()
+            metrics.finish()
+
+    def run(self, collect_garbage=True, workers=1):
         """
         Function that re-calculates weight for documents
+        It is a reconciliation job, run_incremental() covers daily changes.
+        Weights are written to a new generation, readers use the previous
+        one until scoring is finished
+        :param collect_garbage: remove previous generations in background
+        :param workers: number of processes for scoring
         """
-        # Clear previous weight for documents before applying new ones
-        logger.info("Started removing all previous documents weights")
-        DocumentWeight.objects.all().delete()
-        logger.info("Completed removing all previous documents weights")
+        metrics = ScoringMetrics(self.metrics_hooks)
+        with PaywallThresholdCache.invalidation_batch():
+            with metrics.track_queries():
+                paywall_setting = self.score_new_generation(workers, metrics)
+                summary = metrics.finish()
 
-        documents = Document.objects.filter(
-            dc_success=True,
-            status=Document.PUBLISHED
-        )
+            # Keep the summary with the run it describes
+            generation = paywall_setting.generation
+            generation.metrics = json.dumps(summary)
+            generation.save(update_fields=['metrics'])
+
+        if collect_garbage:
+            self.delete_stale_generations_in_background()
+
+    def score_new_generation(self, workers, metrics: ScoringMetrics):
+        """
+        Score all documents into a new generation and activate it
+        :return paywall setting of the new generation
+        """
+        last_mark = DirtyDocument.objects.order_by('-id').first()
+
+        documents = self.get_scored_documents()
         documents_count = documents.count()
 
         logger.info(f"Found {documents_count} documents")
 
-        # Create a new setting for paywall protection
+        # Create a new setting and weight generation for paywall protection
         paywall_setting = self.get_paywall_setting(force_create=True)
         paywall_setting.documents_count = documents_count
 
         # Calculate new weight for documents
-        logger.info("Started scoring documents")
-        start_time = time.time()
-        for document in documents.iterator(chunk_size=self.__chunk_size):
-            weight = DocumentWeightCalculator(document).run()
-
-            DocumentWeight.objects.create(
-                document=document,
-                document_paywall_setting=paywall_setting,
-                weight=round(weight, 5)
-            )
-        end_time = time.time()
-        logger.info(f"Finished scoring documents. "
-                    f"Execution time - {end_time - start_time}")
+        logger.info(f"Started scoring documents. Query budget - "
+                    f"{self.get_query_budget(documents_count)}")
+        if workers > 1:
+            aggregate = self.score_documents_in_parallel(
+                documents, paywall_setting, workers, metrics)
+        else:
+            aggregate = self.score_documents_in_batches(
+                documents, paywall_setting, metrics=metrics)
+
+        self.activate_paywall_setting(paywall_setting, aggregate)
+        logger.info("Activated new documents weights")
 
-        self.make_and_save_aggregation(paywall_setting)
+        # Everything marked before the run start is scored now
+        if last_mark is not None:
+            DirtyDocument.objects.filter(id__lte=last_mark.id).delete()
+
+        return paywall_setting
+
+
+def _score_shard(paywall_setting_id, id_from, id_to, now):
+    """
+    Process pool entry point, scores documents with id in [id_from, id_to)
+    """
+    paywall_setting = DocumentPaywallSetting.objects.get(
+        id=paywall_setting_id)
+    documents = DocumentWeightService.get_scored_documents().filter(
+        id__gte=id_from, id__lt=id_to)
+
+    # Progress is reported by the parent when the shard is merged
+    metrics = ScoringMetrics()
+    try:
+        with metrics.track_queries():
+            aggregate = DocumentWeightService(
+                metrics_hooks=[]).score_documents_in_batches(
+                documents, paywall_setting, now=now, metrics=metrics)
+        return aggregate, metrics
+    finally:
+        connection.close()
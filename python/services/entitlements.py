@@ -0,0 +1,83 @@
+from services.membership_cache import MembershipCache
+
+
+class DocumentEntitlements:
+    """
+    Everything a user is entitled to for document access.
+    Every value is loaded once on first use, so one instance answers
+    all Document.access_allowed checks of a request from memory
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @classmethod
+    def for_request(cls, request) -> 'DocumentEntitlements':
+        """
+        Entitlements of the request user, created once per request
+        """
+        if not hasattr(request, "_document_entitlements"):
+            request._document_entitlements = cls(request.user)
+        return request._document_entitlements
+
+    @property
+    def profile(self):
+        if hasattr(self, "_profile"):
+            return self._profile
+
+        user = self.user
+        self._profile = (
+            user.profile if user and user.is_authenticated else None)
+        return self._profile
+
+    @property
+    def document_ids(self) -> set:
+        """
+        Ids of documents uploaded by the user
+        """
+        if hasattr(self, "_document_ids"):
+            return self._document_ids
+
+        profile = self.profile
+        self._document_ids = set(
+            profile.documents.values_list('id', flat=True)
+            if profile else ())
+        return self._document_ids
+
+    @property
+    def course_ids(self) -> set:
+        """
+        Ids of courses uploaded by the user
+        """
+        if hasattr(self, "_course_ids"):
+            return self._course_ids
+
+        profile = self.profile
+        self._course_ids = set(
+            profile.courses.values_list('id', flat=True)
+            if profile else ())
+        return self._course_ids
+
+    @property
+    def membership_end_date(self):
+        """
+        End date of the latest active membership or None
+        """
+        if hasattr(self, "_membership_end_date"):
+            return self._membership_end_date
+
+        self._membership_end_date = MembershipCache.get_end_date(self.user)
+        return self._membership_end_date
+
+    @property
+    def has_membership(self) -> bool:
+        return MembershipCache.is_active(self.membership_end_date)
+
+    @property
+    def has_essays_access(self) -> bool:
+        if hasattr(self, "_has_essays_access"):
+            return self._has_essays_access
+
+        profile = self.profile
+        self._has_essays_access = bool(profile and profile.has_essays_access)
+        return self._has_essays_access
@@ -0,0 +1,99 @@
+import datetime
+import math
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+
+class MembershipCache:
+    """
+    Per user cache of the end date of the latest active membership.
+    A found membership is cached until it ends, absence of a membership
+    is cached for negative_timeout seconds.
+    Entries are removed when a membership of the user is saved or deleted
+    """
+    key_prefix = 'membership_end_date'
+    negative_timeout = 60
+    no_membership = 'none'
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get_membership_relation():
+        """
+        Relation from memberships to users, resolved when first needed
+        because the membership model belongs to another app
+        """
+        return User.membership_set.rel
+
+    @classmethod
+    def get_key(cls, user_id) -> str:
+        return f'{cls.key_prefix}:{user_id}'
+
+    @staticmethod
+    def get_expires_at(end_date) -> datetime.datetime:
+        """
+        Last moment when the membership is active.
+        A date end_date lasts until the end of the day
+        """
+        if isinstance(end_date, datetime.datetime):
+            return end_date
+
+        next_day = datetime.datetime.combine(
+            end_date + datetime.timedelta(days=1), datetime.time())
+        if settings.USE_TZ:
+            next_day = timezone.make_aware(next_day)
+        return next_day - datetime.timedelta(microseconds=1)
+
+    @classmethod
+    def is_active(cls, end_date) -> bool:
+        return (end_date is not None
+                and timezone.now() <= cls.get_expires_at(end_date))
+
+    @classmethod
+    def get_end_date(cls, user):
+        """
+        End date of the latest active membership of user or None
+        """
+        if user.pk is None:
+            # Anonymous users are not cached
+            return cls.query_end_date(user)
+
+        key = cls.get_key(user.pk)
+        end_date = cache.get(key)
+        if end_date == cls.no_membership:
+            return None
+        if end_date is not None and cls.is_active(end_date):
+            return end_date
+
+        end_date = cls.query_end_date(user)
+        if end_date is None:
+            cache.set(key, cls.no_membership, timeout=cls.negative_timeout)
+        else:
+            seconds_left = (
+                cls.get_expires_at(end_date) - timezone.now()
+            ).total_seconds()
+            cache.set(key, end_date, timeout=max(math.ceil(seconds_left), 1))
+        return end_date
+
+    @staticmethod
+    def query_end_date(user):
+        return user.membership_set \
+            .filter(end_date__gte=timezone.now()) \
+            .aggregate(Max('end_date'))['end_date__max']
+
+    @classmethod
+    def invalidate(cls, membership):
+        """
+        Forget the cached membership of the user of membership
+        after the current transaction is committed
+        """
+        user_id = getattr(
+            membership, cls.get_membership_relation().field.attname)
+        key = cls.get_key(user_id)
+        transaction.on_commit(lambda: cache.delete(key))
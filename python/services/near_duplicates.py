@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import random
+import re
+import threading
+import zlib
+
+from array import array
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+
+from models import Document, DocumentMinHash, DocumentLshBucket
+
+logger = logging.getLogger('import')
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts and their LSH band buckets.
+    Two texts share a bucket with probability 1 - (1 - s^rows)^bands
+    where s is Jaccard similarity of their word shingles, so with
+    32 bands of 4 rows copies with s >= 0.7 almost surely meet and texts
+    with s <= 0.3 rarely do
+    """
+    prime = (1 << 61) - 1
+
+    def __init__(self, permutations: int = 128, bands: int = 32,
+                 shingle_size: int = 5, seed: int = 1):
+        if permutations % bands:
+            raise ValueError('permutations must be divisible by bands')
+
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = permutations // bands
+        self.shingle_size = shingle_size
+
+        # Fixed seed, signatures have to be comparable between processes
+        generator = random.Random(seed)
+        self.coefficients = [
+            (generator.randrange(1, self.prime),
+             generator.randrange(0, self.prime))
+            for _ in range(permutations)
+        ]
+
+    def get_shingles(self, text: str) -> Set[int]:
+        words = re.findall(r'\w+', text.lower())
+        size = self.shingle_size
+        if len(words) < size:
+            size = max(len(words), 1)
+
+        return {
+            zlib.crc32(' '.join(words[i:i + size]).encode())
+            for i in range(max(len(words) - size + 1, 1))
+        } if words else set()
+
+    def get_signature(self, text: str) -> array:
+        """
+        Min hash of shingles for every permutation, empty for texts
+        without words
+        """
+        shingles = self.get_shingles(text)
+        if not shingles:
+            return array('Q')
+
+        prime = self.prime
+        return array('Q', (
+            min((a * shingle + b) % prime for shingle in shingles)
+            for a, b in self.coefficients
+        ))
+
+    def get_buckets(self, signature: array) -> List[int]:
+        """
+        One bucket per band, the band number is part of the bucket
+        """
+        buckets = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.blake2b(
+                band.to_bytes(2, 'big') + rows.tobytes(),
+                digest_size=8).digest()
+            buckets.append(int.from_bytes(digest, 'big', signed=True))
+        return buckets
+
+    @staticmethod
+    def get_similarity(signature: array, other: array) -> float:
+        """
+        Estimated Jaccard similarity of texts of signatures
+        """
+        if not signature or len(signature) != len(other):
+            return 0.0
+        return sum(
+            1 for a, b in zip(signature, other) if a == b) / len(signature)
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of converted documents text.
+    Candidates are documents sharing an LSH bucket, only they are
+    compared, so lookups don't depend on the number of documents
+    """
+    # Texts are cut to keep indexing time of huge documents bounded
+    max_text_size = 2 * 1024 * 1024
+    similarity_threshold = 0.8
+    # Documents of bigger buckets are compared with the first one only
+    # instead of every pair
+    max_bucket_pairs_size = 100
+
+    hasher = MinHasher()
+
+    _executor = None
+    _executor_lock = threading.Lock()
+    # Documents queued for indexing
+    _pending_ids: Set[int] = set()
+
+    @classmethod
+    def read_text(cls, document) -> str:
+        with document.dc_text.open('rb') as text_file:
+            return text_file.read(cls.max_text_size).decode(
+                'utf-8', errors='ignore')
+
+    @classmethod
+    def index_document(cls, document):
+        """
+        Replace signature and buckets of a converted document
+        """
+        signature = cls.hasher.get_signature(cls.read_text(document))
+        buckets = cls.hasher.get_buckets(signature) if signature else []
+
+        with transaction.atomic():
+            DocumentMinHash.objects.update_or_create(
+                document=document,
+                defaults={
+                    'signature': signature.tobytes(),
+                    'dc_text': document.dc_text.name,
+                })
+            DocumentLshBucket.objects.filter(document=document).delete()
+            DocumentLshBucket.objects.bulk_create([
+                DocumentLshBucket(document=document, bucket=bucket)
+                for bucket in buckets
+            ])
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        # Created on first use, after the server forked its workers.
+        # Hashing holds the GIL, one thread keeps it from taking over
+        # the web worker
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=getattr(
+                        settings, 'NEAR_DUPLICATE_INDEX_WORKERS', 1),
+                    thread_name_prefix='near-duplicate-index')
+        return cls._executor
+
+    @classmethod
+    def index_document_in_background(cls, document_id) -> Optional[Future]:
+        """
+        Queue indexing of the document, a document that is queued
+        already is not queued again
+        """
+        with cls._executor_lock:
+            if document_id in cls._pending_ids:
+                return None
+            cls._pending_ids.add(document_id)
+
+        def run():
+            with cls._executor_lock:
+                cls._pending_ids.discard(document_id)
+            try:
+                cls.index_document(Document.objects.get(id=document_id))
+            except Exception:
+                logger.exception(
+                    f"Failed to index document {document_id} "
+                    f"for near duplicates")
+            finally:
+                # Connection of the executor thread
+                connection.close()
+
+        return cls.get_executor().submit(run)
+
+    @classmethod
+    def get_signatures(cls, document_ids) -> Dict[int, array]:
+        signatures = {}
+        rows = DocumentMinHash.objects \
+            .filter(document_id__in=document_ids) \
+            .values_list('document_id', 'signature')
+        for document_id, signature_bytes in rows:
+            signature = array('Q')
+            signature.frombytes(bytes(signature_bytes))
+            signatures[document_id] = signature
+        return signatures
+
+    @classmethod
+    def get_similar(cls, document_id, threshold=None) -> List[tuple]:
+        """
+        Documents similar to the document
+        :return [(document id, similarity)] most similar first
+        """
+        threshold = threshold or cls.similarity_threshold
+        buckets = DocumentLshBucket.objects \
+            .filter(document_id=document_id) \
+            .values_list('bucket', flat=True)
+        candidate_ids = set(
+            DocumentLshBucket.objects
+            .filter(bucket__in=buckets)
+            .exclude(document_id=document_id)
+            .values_list('document_id', flat=True))
+        if not candidate_ids:
+            return []
+
+        signatures = cls.get_signatures(candidate_ids | {document_id})
+        signature = signatures.pop(document_id, None)
+        if signature is None:
+            return []
+
+        similar = [
+            (candidate_id, cls.hasher.get_similarity(signature, other))
+            for candidate_id, other in signatures.items()
+        ]
+        return sorted(
+            (item for item in similar if item[1] >= threshold),
+            key=lambda item: -item[1])
+
+    @classmethod
+    def get_clusters(cls, school_id, threshold=None) -> List[List[int]]:
+        """
+        Groups of near duplicate documents of the school, largest first
+        """
+        threshold = threshold or cls.similarity_threshold
+        school_buckets = DocumentLshBucket.objects.filter(
+            document__school_id=school_id)
+        shared_buckets = school_buckets \
+            .values('bucket') \
+            .annotate(documents=Count('document_id')) \
+            .filter(documents__gt=1) \
+            .values('bucket')
+
+        bucket_documents = defaultdict(list)
+        rows = school_buckets \
+            .filter(bucket__in=shared_buckets) \
+            .values_list('bucket', 'document_id')
+        for bucket, document_id in rows:
+            bucket_documents[bucket].append(document_id)
+
+        candidate_pairs = set()
+        for document_ids in bucket_documents.values():
+            document_ids.sort()
+            if len(document_ids) > cls.max_bucket_pairs_size:
+                candidate_pairs.update(
+                    (document_ids[0], other_id)
+                    for other_id in document_ids[1:])
+                continue
+
+            for i, document_id in enumerate(document_ids):
+                for other_id in document_ids[i + 1:]:
+                    candidate_pairs.add((document_id, other_id))
+
+        signatures = cls.get_signatures(
+            {document_id for pair in candidate_pairs for document_id in pair})
+
+        # Union-find of documents connected by similar pairs
+        parents = {}
+
+        def find(document_id):
+            parents.setdefault(document_id, document_id)
+            while parents[document_id] != document_id:
+                parents[document_id] = parents[parents[document_id]]
+                document_id = parents[document_id]
+            return document_id
+
+        for document_id, other_id in candidate_pairs:
+            signature = signatures.get(document_id)
+            other = signatures.get(other_id)
+            if signature is None or other is None:
+                continue
+            if cls.hasher.get_similarity(signature, other) >= threshold:
+                parents[find(document_id)] = find(other_id)
+
+        clusters = defaultdict(list)
+        for document_id in list(parents):
+            clusters[find(document_id)].append(document_id)
+        return sorted(
+            (sorted(cluster) for cluster in clusters.values()
+             if len(cluster) > 1),
+            key=lambda cluster: (-len(cluster), cluster[0]))
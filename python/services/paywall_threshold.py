@@ -0,0 +1,118 @@
+import threading
+
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from services.document_id_bitmap import DocumentIdBitmap
+from services.versioned_cache import VersionedCache
+
+
+class PaywallThresholdCache(VersionedCache):
+    """
+    Process-local cache of the active paywall setting id, the max
+    weight for free access and the published set of free documents
+    """
+    version_key = 'document_paywall_threshold_version'
+
+    # (version token, paywall setting id, max weight for free access,
+    #  free documents bitmap or None)
+    _state = None
+    # pending flag of invalidation_batch() blocks
+    _local = threading.local()
+
+    @classmethod
+    def get(cls) -> Tuple[int, float]:
+        """
+        Active paywall setting id and max weight for free access
+        Raises DocumentPaywallSetting.DoesNotExist if documents were
+        not scored yet
+        """
+        state = cls._get_state()
+        return state[1], state[2]
+
+    @classmethod
+    def get_free_documents(cls) -> Optional[DocumentIdBitmap]:
+        """
+        Documents with free access in the active setting.
+        None when the set wasn't published, then weights have to be
+        compared with the threshold
+        """
+        return cls._get_state()[3]
+
+    @classmethod
+    def _get_state(cls):
+        from models import DocumentWeightGeneration
+
+        version = cls.get_version()
+        state = cls._state
+        if state is None or state[0] != version:
+            setting = DocumentWeightGeneration.get_active_paywall_setting()
+            max_weight = \
+                DocumentWeightGeneration.get_max_weight_for_free_access(
+                    setting)
+            free_documents = None
+
+            published = cls._load_free_documents(setting.id)
+            if published is not None:
+                # The set and its threshold are fixed until the next full
+                # scoring, percentile change or edit of the setting,
+                # incremental scoring only updates the documents it
+                # rescored
+                free_documents, max_weight = published
+
+            state = (version, setting.id, max_weight, free_documents)
+            cls._state = state
+
+        return state
+
+    @staticmethod
+    def _load_free_documents(setting_id):
+        """
+        Published (free documents bitmap, max weight it was built with)
+        of the setting or None
+        """
+        from models import DocumentWeightGeneration
+
+        published = DocumentWeightGeneration.objects \
+            .filter(paywall_setting_id=setting_id) \
+            .values_list('free_documents', 'free_documents_weight') \
+            .first()
+        if published is None or published[0] is None:
+            return None
+
+        free_documents, free_documents_weight = published
+        return DocumentIdBitmap.loads(free_documents), free_documents_weight
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Make every worker reload the threshold after the current
+        transaction is committed
+        """
+        if getattr(cls._local, 'pending', None) is not None:
+            cls._local.pending = True
+            return
+
+        super().invalidate()
+
+    @classmethod
+    @contextmanager
+    def invalidation_batch(cls):
+        """
+        Invalidate once for all changes made in the block, so that a
+        scoring run that saves its setting several times makes workers
+        reload the threshold and the free set once
+        """
+        if getattr(cls._local, 'pending', None) is not None:
+            # Nested block, the outer one invalidates
+            yield
+            return
+
+        cls._local.pending = False
+        try:
+            yield
+        finally:
+            pending = cls._local.pending
+            cls._local.pending = None
+            if pending:
+                cls.invalidate()
@@ -0,0 +1,124 @@
+import json
+import math
+import random
+
+from typing import List
+
+
+class KLLSketch:
+    """
+    Mergeable streaming quantile sketch (Karnin, Lang, Liberty).
+    Keeps O(k) values in levels of compactors, a value on level h stands
+    for 2^h original values. Rank error is about 1.7 / k of the stream size
+    """
+
+    def __init__(self, k: int = 200, c: float = 2 / 3):
+        self.k = k
+        self.c = c
+        self.compactors: List[List[float]] = [[]]
+        self.count = 0
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    @property
+    def _size(self) -> int:
+        return sum(len(compactor) for compactor in self.compactors)
+
+    @property
+    def _max_size(self) -> int:
+        return sum(
+            self._capacity(level) for level in range(len(self.compactors)))
+
+    def _compact(self, level: int):
+        """
+        Sort the level and promote every second value to the next level
+        """
+        if level + 1 == len(self.compactors):
+            self.compactors.append([])
+
+        compactor = sorted(self.compactors[level])
+        # An odd value stays on the level
+        rest = [compactor.pop()] if len(compactor) % 2 else []
+        offset = random.randint(0, 1)
+
+        self.compactors[level + 1].extend(compactor[offset::2])
+        self.compactors[level] = rest
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for level in range(len(self.compactors)):
+                if len(self.compactors[level]) >= self._capacity(level):
+                    self._compact(level)
+                    break
+
+    def update(self, value: float):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other: 'KLLSketch'):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.count += other.count
+        self._compress()
+
+    def _weighted_values(self):
+        values = [
+            (value, 2 ** level)
+            for level, compactor in enumerate(self.compactors)
+            for value in compactor
+        ]
+        return sorted(values)
+
+    def quantile(self, q: float):
+        """
+        Approximate value with rank q * count, q is in [0, 1]
+        """
+        values = self._weighted_values()
+        if not values:
+            return None
+
+        total_weight = sum(weight for _, weight in values)
+        target_weight = q * total_weight
+
+        cumulative_weight = 0
+        for value, weight in values:
+            cumulative_weight += weight
+            if cumulative_weight >= target_weight:
+                return value
+        return values[-1][0]
+
+    def rank(self, value: float) -> float:
+        """
+        Approximate share of values that are less or equal to value
+        """
+        values = self._weighted_values()
+        if not values:
+            return 0
+
+        total_weight = sum(weight for _, weight in values)
+        return sum(
+            weight for item, weight in values if item <= value
+        ) / total_weight
+
+    def dumps(self) -> str:
+        return json.dumps({
+            'k': self.k,
+            'c': self.c,
+            'count': self.count,
+            'compactors': self.compactors,
+        })
+
+    @classmethod
+    def loads(cls, data: str) -> 'KLLSketch':
+        data = json.loads(data)
+        sketch = cls(k=data['k'], c=data['c'])
+        sketch.compactors = data['compactors']
+        sketch.count = data['count']
+        return sketch
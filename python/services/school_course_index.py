@@ -0,0 +1,183 @@
+import bisect
+
+from school.models import School, CourseStructure
+from services.versioned_cache import VersionedCache
+
+
+class LookupNotIndexed(Exception):
+    """
+    The lookup has to be answered by the database
+    """
+
+
+class FieldIndex:
+    """
+    Ids by values of one field: hash maps for exact and iexact lookups,
+    sorted values for startswith and istartswith.
+    The smallest id wins like in queryset.first()
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.iexact = {}
+
+    def add(self, value, id_):
+        if value is None:
+            # NULL doesn't match any lookup value
+            return
+        self.exact.setdefault(value, id_)
+        self.iexact.setdefault(value.upper(), id_)
+
+    def freeze(self):
+        self.values = sorted(self.exact)
+        self.ivalues = sorted(self.iexact)
+
+    @staticmethod
+    def _find_prefix(values, ids, prefix):
+        """
+        Smallest id of values starting with prefix
+        """
+        found_ids = []
+        position = bisect.bisect_left(values, prefix)
+        while position < len(values) and values[position].startswith(prefix):
+            found_ids.append(ids[values[position]])
+            position += 1
+        return min(found_ids) if found_ids else None
+
+    def find(self, operator, value):
+        if value is None:
+            return None
+        value = str(value)
+
+        if operator in (None, 'exact'):
+            return self.exact.get(value)
+        if operator == 'iexact':
+            return self.iexact.get(value.upper())
+        if operator == 'startswith':
+            return self._find_prefix(self.values, self.exact, value)
+        if operator == 'istartswith':
+            return self._find_prefix(
+                self.ivalues, self.iexact, value.upper())
+        raise LookupNotIndexed(operator)
+
+
+class SchoolCourseIndex(VersionedCache):
+    """
+    Process-local index of school and course structure lookups
+    of seed uploads.
+    Schools are found by lookup ("short_name: name"), short_name, name
+    or id, course structures of a school by short_name. Other lookups
+    raise LookupNotIndexed.
+    Saving or deleting a school or a course structure makes every worker
+    reload its copy. Changes made with queryset.update() have to call
+    invalidate() themselves
+    """
+    version_key = 'school_course_index_version'
+
+    school_fields = ('lookup', 'short_name', 'name')
+    course_fields = ('short_name',)
+
+    # (version token, SchoolCourseIndex)
+    _state = None
+
+    def __init__(self):
+        self.schools = {}
+        self.school_fields_index = {
+            field: FieldIndex() for field in self.school_fields}
+        self.course_structures = {}
+        # school id: {field: FieldIndex}
+        self.school_courses_index = {}
+
+    @classmethod
+    def load(cls) -> 'SchoolCourseIndex':
+        index = cls()
+
+        schools = School.objects \
+            .order_by('id') \
+            .values_list('id', 'short_name', 'name')
+        for school_id, short_name, name in schools.iterator():
+            index.schools[school_id] = (short_name, name)
+            values = {
+                # Concat of the database treats NULL as empty string
+                'lookup': f'{short_name or ""}: {name or ""}',
+                'short_name': short_name,
+                'name': name,
+            }
+            for field, field_index in index.school_fields_index.items():
+                field_index.add(values[field], school_id)
+
+        course_structures = CourseStructure.objects \
+            .order_by('id') \
+            .values_list('id', 'school_id', 'short_name')
+        for course_structure_id, school_id, short_name in \
+                course_structures.iterator():
+            index.course_structures[course_structure_id] = (
+                school_id, short_name)
+            courses_index = index.school_courses_index.setdefault(
+                school_id,
+                {field: FieldIndex() for field in cls.course_fields})
+            courses_index['short_name'].add(short_name, course_structure_id)
+
+        for field_index in index.school_fields_index.values():
+            field_index.freeze()
+        for courses_index in index.school_courses_index.values():
+            for field_index in courses_index.values():
+                field_index.freeze()
+        return index
+
+    @classmethod
+    def get(cls) -> 'SchoolCourseIndex':
+        version = cls.get_version()
+        state = cls._state
+        if state is None or state[0] != version:
+            state = (version, cls.load())
+            cls._state = state
+        return state[1]
+
+    @staticmethod
+    def _split_lookup(lookup):
+        field, _, operator = lookup.partition('__')
+        return field, operator or None
+
+    def find_school(self, lookup, value):
+        """
+        School with the lookup value or None.
+        The school has id, short_name and name only
+        """
+        field, operator = self._split_lookup(lookup)
+        if field in ('id', 'pk') and operator in (None, 'exact'):
+            try:
+                school_id = int(value)
+            except (TypeError, ValueError):
+                raise LookupNotIndexed(lookup)
+            school_id = school_id if school_id in self.schools else None
+        elif field in self.school_fields_index:
+            school_id = self.school_fields_index[field].find(operator, value)
+        else:
+            raise LookupNotIndexed(lookup)
+
+        if school_id is None:
+            return None
+        short_name, name = self.schools[school_id]
+        return School(id=school_id, short_name=short_name, name=name)
+
+    def find_course_structure(self, school_id, lookup, value):
+        """
+        Course structure of the school with the lookup value or None.
+        The course structure has id, school_id and short_name only
+        """
+        field, operator = self._split_lookup(lookup)
+        if field not in self.course_fields:
+            raise LookupNotIndexed(lookup)
+
+        courses_index = self.school_courses_index.get(school_id)
+        if courses_index is None:
+            return None
+
+        course_structure_id = courses_index[field].find(operator, value)
+        if course_structure_id is None:
+            return None
+        _, short_name = self.course_structures[course_structure_id]
+        return CourseStructure(
+            id=course_structure_id, school_id=school_id,
+            short_name=short_name)
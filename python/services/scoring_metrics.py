@@ -0,0 +1,272 @@
+import bisect
+import logging
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('import')
+
+
+class QueryCounter:
+    """
+    Database execute wrapper that counts queries and their time
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start_time
+            self.count += 1
+
+
+class Histogram:
+    """
+    Timing histogram with fixed buckets in seconds
+    """
+    buckets = (
+        0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+        0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60
+    )
+
+    def __init__(self):
+        # The last counter is for values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        labels = [str(bucket) for bucket in self.buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class ScoringMetricsHook:
+    """
+    Receiver of scoring metrics, subclasses export them somewhere
+    """
+
+    def on_batch(self, batch: dict):
+        pass
+
+    def on_finish(self, summary: dict):
+        pass
+
+
+class LoggingMetricsHook(ScoringMetricsHook):
+    def on_batch(self, batch: dict):
+        logger.info(
+            f"Scored {batch['documents_total']} documents, "
+            f"{batch['documents_per_second']} documents/s. "
+            f"Batch: {batch['documents']} documents, "
+            f"{batch['queries']} queries in {batch['query_seconds']}s")
+
+    def on_finish(self, summary: dict):
+        rules = ', '.join(
+            f"{name} - {histogram['sum']}s"
+            for name, histogram in summary['rules'].items())
+        logger.info(
+            f"Scoring summary: {summary['documents']} documents "
+            f"in {summary['seconds']}s, {summary['queries']} queries "
+            f"in {summary['query_seconds']}s. Rules: {rules}")
+
+
+class StubMetricsHook(ScoringMetricsHook):
+    """
+    Keeps everything in memory, for local runs and tests
+    """
+
+    def __init__(self):
+        self.batches: List[dict] = []
+        self.summaries: List[dict] = []
+
+    def on_batch(self, batch: dict):
+        self.batches.append(batch)
+
+    def on_finish(self, summary: dict):
+        self.summaries.append(summary)
+
+
+def get_default_hooks() -> List[ScoringMetricsHook]:
+    """
+    Hooks listed in DOCUMENT_SCORING_METRICS_HOOKS setting
+    """
+    hook_paths = getattr(
+        settings, 'DOCUMENT_SCORING_METRICS_HOOKS',
+        ['services.scoring_metrics.LoggingMetricsHook'])
+    return [import_string(path)() for path in hook_paths]
+
+
+class ScoringMetrics:
+    """
+    Metrics of one scoring run: timing of every rule, queries of every
+    batch and scoring progress.
+    Can be pickled and merged, so workers of a process pool collect
+    their own metrics and the parent combines them
+    """
+
+    def __init__(self, hooks: List[ScoringMetricsHook] = None):
+        self.hooks = hooks if hooks is not None else []
+        self.rules: Dict[str, Histogram] = defaultdict(Histogram)
+        self.batch_seconds = Histogram()
+        self.documents = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.started_at = time.perf_counter()
+        self._query_counter = None
+        self._batch_started_at = None
+        self._batch_queries_start = (0, 0.0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Hooks may hold resources that can't be sent to other processes
+        state['hooks'] = []
+        state['_query_counter'] = None
+        state['rules'] = dict(self.rules)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rules = defaultdict(Histogram, self.rules)
+
+    def observe_rule(self, rule_name: str, seconds: float):
+        self.rules[rule_name].observe(seconds)
+
+    @contextmanager
+    def track_queries(self):
+        """
+        Count queries of the default connection while the block runs
+        """
+        self._query_counter = QueryCounter()
+        self._batch_queries_start = (0, 0.0)
+        self._batch_started_at = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._query_counter):
+                yield self
+        finally:
+            self._query_counter = None
+
+    def _take_queries(self):
+        """
+        Queries counted since the previous call
+        """
+        if self._query_counter is None:
+            return 0, 0.0
+
+        queries_start, query_seconds_start = self._batch_queries_start
+        queries = self._query_counter.count - queries_start
+        query_seconds = self._query_counter.seconds - query_seconds_start
+        self._batch_queries_start = (
+            self._query_counter.count, self._query_counter.seconds)
+        return queries, query_seconds
+
+    def finish_batch(self, documents_count: int):
+        """
+        Record a scored batch, queries made since the previous batch
+        belong to it
+        """
+        now = time.perf_counter()
+        queries, query_seconds = self._take_queries()
+        self.queries += queries
+        self.query_seconds += query_seconds
+
+        batch_seconds = now - (self._batch_started_at or self.started_at)
+        self._batch_started_at = now
+
+        self.documents += documents_count
+        self.batch_seconds.observe(batch_seconds)
+
+        self.send_batch({
+            'documents': documents_count,
+            'seconds': round(batch_seconds, 3),
+            'queries': queries,
+            'query_seconds': round(query_seconds, 3),
+        })
+
+    def send_batch(self, batch: dict):
+        batch.update({
+            'documents_total': self.documents,
+            'documents_per_second': self.documents_per_second,
+        })
+        for hook in self.hooks:
+            hook.on_batch(batch)
+
+    @property
+    def documents_per_second(self) -> float:
+        seconds = time.perf_counter() - self.started_at
+        return round(self.documents / seconds, 1) if seconds else 0.0
+
+    def merge(self, other: 'ScoringMetrics'):
+        """
+        Add metrics of a worker and report its progress
+        """
+        for rule_name, histogram in other.rules.items():
+            self.rules[rule_name].merge(histogram)
+        self.batch_seconds.merge(other.batch_seconds)
+        self.documents += other.documents
+        self.queries += other.queries
+        self.query_seconds += other.query_seconds
+
+        self.send_batch({
+            'documents': other.documents,
+            'seconds': round(other.batch_seconds.sum, 3),
+            'queries': other.queries,
+            'query_seconds': round(other.query_seconds, 3),
+        })
+
+    def summary(self) -> dict:
+        return {
+            'documents': self.documents,
+            'seconds': round(time.perf_counter() - self.started_at, 3),
+            'documents_per_second': self.documents_per_second,
+            'queries': self.queries,
+            'query_seconds': round(self.query_seconds, 3),
+            'batch_seconds': self.batch_seconds.to_dict(),
+            'rules': {
+                name: histogram.to_dict()
+                for name, histogram in self.rules.items()
+            },
+        }
+
+    def finish(self) -> dict:
+        """
+        Send the summary to hooks.
+        Queries made outside of batches are added to the totals
+        """
+        queries, query_seconds = self._take_queries()
+        self.queries += queries
+        self.query_seconds += query_seconds
+
+        summary = self.summary()
+        for hook in self.hooks:
+            hook.on_finish(summary)
+        return summary
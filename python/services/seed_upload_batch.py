@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import zipfile
+
+from datetime import datetime
+
+from django.core.files import File
+from django.db import transaction
+
+from models import Document
+from services.conversion_scheduler import ConversionScheduler
+from services.near_duplicates import NearDuplicateIndex
+from services.seed_upload_resolver import SeedUploadResolver
+
+
+class SeedUploadBatch:
+    """
+    Seed upload of many documents in one request: a JSON manifest and
+    a zip or tar archive with the files.
+    Manifest is a list of objects with "file" (path in the archive) and
+    the fields of a single seed upload: name, gb_school, gb_school_lookup,
+    gb_course, gb_course_lookup, school, course, professor.
+    Entries are read from the archive one by one without unpacking it,
+    schools and courses are resolved once per distinct value and
+    documents are inserted in batches
+    """
+    batch_size = 500
+    # Entries up to this size are spooled in memory
+    spool_max_size = 8 * 1024 * 1024
+    block_size = 1024 * 1024
+
+    def __init__(self, request):
+        self.request = request
+        self.resolver = SeedUploadResolver()
+        self.convert_document = self.get_flag("convert_document", True)
+        self.document_field = Document._meta.get_field('document')
+
+        self.created_ids = []
+        self.errors = []
+
+    def get_flag(self, name, default):
+        value = self.request.POST.get(name)
+        if value is None:
+            return default
+        return value.lower() in ("1", "true", "yes", "on")
+
+    @property
+    def manifest(self) -> dict:
+        """
+        Manifest entries by path in the archive
+        """
+        if hasattr(self, "_manifest"):
+            return self._manifest
+
+        manifest_file = self.request.FILES.get("manifest")
+        if manifest_file is not None:
+            entries = json.load(manifest_file)
+        else:
+            entries = json.loads(self.request.POST.get("manifest") or "[]")
+
+        if not isinstance(entries, list):
+            raise ValueError("Manifest has to be a list of files")
+
+        self._manifest = {entry["file"]: entry for entry in entries}
+        return self._manifest
+
+    def iter_archive(self):
+        """
+        (path, stream, size) of every file in the archive
+        """
+        archive = self.request.FILES.get("archive")
+        if archive is None:
+            raise ValueError('"archive" is required')
+
+        if zipfile.is_zipfile(archive):
+            archive.seek(0)
+            with zipfile.ZipFile(archive) as zip_file:
+                for info in zip_file.infolist():
+                    if info.is_dir():
+                        continue
+                    with zip_file.open(info) as stream:
+                        yield info.filename, stream, info.file_size
+            return
+
+        archive.seek(0)
+        # Stream mode reads members in order without seeking back
+        with tarfile.open(fileobj=archive, mode='r|*') as tar_file:
+            for member in tar_file:
+                if not member.isfile():
+                    continue
+                yield member.name, tar_file.extractfile(member), member.size
+
+    def generate_document(self, entry):
+        gb_school = self.resolver.get_school(
+            entry.get("gb_school"), entry.get("gb_school_lookup"))
+        gb_course = self.resolver.get_course(
+            gb_school, entry.get("gb_course"), entry.get("gb_course_lookup"))
+
+        document = Document(
+            notetaker=self.resolver.user,
+            title=self.resolver.get_document_title(
+                entry, gb_school, gb_course),
+            publisher=Document.test,
+            status=Document.DRAFT,
+            school=gb_school,
+            course=gb_course,
+            dc_success=None)
+        document.updated_at = datetime.utcnow()
+        # bulk_create doesn't call save(), which fills the slug
+        document.slug = document.get_slug_value()
+        return document
+
+    def spool_entry(self, stream):
+        """
+        Seekable copy of the archive entry and its md5,
+        storages may read a file more than once
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        md5 = hashlib.md5()
+        for block in iter(lambda: stream.read(self.block_size), b''):
+            md5.update(block)
+            spool.write(block)
+        spool.seek(0)
+        return spool, md5.hexdigest()
+
+    def store_file(self, document, path, stream):
+        """
+        Save the archive entry to the storage of the document field
+        unless the same content is stored already
+        """
+        spool, document.md5 = self.spool_entry(stream)
+        with spool:
+            original = Document.find_stored_duplicate(document.md5)
+            if original is not None:
+                # The same content is stored and converted already
+                document.link_stored_file(original)
+                return
+
+            file_name = os.path.basename(path)
+            name = self.document_field.generate_filename(document, file_name)
+            document.document.name = self.document_field.storage.save(
+                name, File(spool, name=file_name),
+                max_length=self.document_field.max_length)
+
+    def save_documents(self, documents):
+        """
+        Insert documents with bulk_create, which sends no post_save.
+        The signals are not needed here: dirty marks are for published
+        documents and these are drafts, new files are indexed for near
+        duplicates when their conversion saves them. Only linked
+        duplicates that are converted already are indexed here
+        """
+        documents = Document.objects.bulk_create(documents)
+        self.created_ids += [document.id for document in documents]
+
+        if self.convert_document:
+            ConversionScheduler.submit(
+                (document.id for document in documents
+                 if not document.dc_success),
+                ConversionScheduler.SEED)
+
+        for document in documents:
+            if document.dc_success and document.dc_text:
+                transaction.on_commit(
+                    lambda document_id=document.id:
+                    NearDuplicateIndex.index_document_in_background(
+                        document_id))
+
+    def run(self):
+        manifest = self.manifest
+        found_paths = set()
+        documents = []
+
+        for path, stream, _ in self.iter_archive():
+            entry = manifest.get(path)
+            if entry is None:
+                continue
+            found_paths.add(path)
+
+            try:
+                document = self.generate_document(entry)
+                self.store_file(document, path, stream)
+            except Exception as ex:
+                self.errors.append({"file": path, "error": str(ex)})
+                continue
+
+            documents.append(document)
+            if len(documents) >= self.batch_size:
+                self.save_documents(documents)
+                documents = []
+
+        if documents:
+            self.save_documents(documents)
+
+        for path in manifest.keys() - found_paths:
+            self.errors.append({"file": path, "error": "Not in the archive"})
+
+        return self.created_ids, self.errors
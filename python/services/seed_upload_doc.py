@@ -1,33 +1,32 @@
 import tempfile
 from datetime import datetime
 
-from django.contrib.auth.models import User
-from django.db.models import F, Value
-from django.db.models.functions import Concat
-
-from accounts.models import UserProfile
 from forms import DocumentUploadForm
 from models import Document
-from school.models import (
-    School,
-    CourseStructure,
-    Course,
-    Professor,
-    Term,
-)
+from services.conversion_scheduler import ConversionScheduler
+from services.seed_upload_resolver import SeedUploadResolver
+from services.storage_handoff import StorageHandoff
+from services.upload_finalizer import UploadFinalizer
 from utils import plupload
 
 
 class SeedUploadDoc:
     _is_last_chunk: bool
+    _is_finalizing: bool
 
     def __init__(self, request):
         self.request = request
         self.tmp_file_destination = 'media/tmp/'
-        self.convert_document = request.POST.get("convert_document",
-                                                 True) is True
-        self.wait_for_convert = request.POST.get("wait_for_convert",
-                                                 True) is True
+        self.convert_document = self.get_flag("convert_document", True)
+        # Store and convert in the request, by default it is done
+        # in background and the client polls the document status
+        self.wait_for_convert = self.get_flag("wait_for_convert", False)
+
+    def get_flag(self, name, default):
+        value = self.request.POST.get(name)
+        if value is None:
+            return default
+        return value.lower() in ("1", "true", "yes", "on")
 
     @property
     def file_form(self):
@@ -75,116 +74,48 @@ class SeedUploadDoc:
         return self._file_object
 
     @property
-    def user(self):
-        if hasattr(self, "_user"):
-            return self._user
+    def resolver(self):
+        if not hasattr(self, "_resolver"):
+            self._resolver = SeedUploadResolver()
+        return self._resolver
 
-        user = User.objects.filter(username='admin@test.com').first()
-        profile = getattr(user, "profile", None)
-        if profile is None:
-            UserProfile.objects.create(user=user, alias="admin1",
-                                       school=self.default_school)
-
-        self._user = user
-        return self._user
+    @property
+    def user(self):
+        return self.resolver.user
 
     @property
     def gb_school(self):
         if hasattr(self, "_gb_school"):
             return self._gb_school
 
-        school_name, school_lookup = (
+        self._gb_school = self.resolver.get_school(
             self.request.POST.get("gb_school"),
-            self.request.POST.get("gb_school_lookup") or "lookup"
-        )
-
-        lookup_concat = Concat(F("short_name"), Value(": "), F("name"))
-        school = School.objects \
-            .annotate(lookup=lookup_concat) \
-            .filter(**{school_lookup: school_name}) \
-            .first()
-
-        if not school:
-            school = self.default_school
-
-        self._gb_school = school
+            self.request.POST.get("gb_school_lookup"))
         return self._gb_school
 
     @property
     def default_school(self):
-        if hasattr(self, "_default_school"):
-            return self._default_school
-
-        self._default_school = School.objects.filter(short_name='UCLA').first()
-        return self._default_school
+        return self.resolver.default_school
 
     @property
     def gb_course(self):
         if hasattr(self, "_gb_course"):
             return self._gb_course
 
-        school = self.gb_school
-        if not school:
-            self._gb_course = None
-            return self._gb_course
-
-        course_name, course_lookup = (
+        self._gb_course = self.resolver.get_course(
+            self.gb_school,
             self.request.POST.get("gb_course"),
-            self.request.POST.get("gb_course_lookup") or "short_name"
-        )
-        course_structure = CourseStructure.objects.filter(
-            **{course_lookup: course_name},
-            school_id=school.id
-        ).first()
-        if not course_structure:
-            self._course = None
-            return self._course
-
-        professor = Professor.objects \
-            .filter(first_name__iexact="A",
-                    last_name__iexact="Staff",
-                    school_id=school.id) \
-            .first()
-
-        if not professor:
-            professor = Professor(
-                first_name='A',
-                last_name='Staff',
-                full_name='Staff, A',
-                school_id=school.id)
-            professor.save()
-
-        term, _ = Term.objects.get_or_create(school_id=school.id, year=1)
-        course, _ = Course.objects.get_or_create(
-            term=term,
-            course_structure=course_structure,
-            professor=professor,
-            status=Course.CROWD)
-        self._course = course
-        return self._course
+            self.request.POST.get("gb_course_lookup"))
+        return self._gb_course
 
     @property
     def document_title(self):
         if hasattr(self, "_document_title"):
             return self._document_title
 
-        doc_name, school_name, course_name, professor_name = (
-            self.request.POST.get("name") or "UndefinedDocName",
-            self.request.POST.get("school") or "UndefinedSchool",
-            self.request.POST.get("course") or "UndefinedCourse",
-            self.request.POST.get("professor") or "UndefinedProfessor"
-        )
-
-        gb_school, gb_course = self.gb_school, self.gb_course
-        if gb_school and gb_course:
-            title = doc_name
-
-        elif gb_school and not gb_course:
-            title = f"{gb_school.name}__{course_name}__{professor_name}"
-
-        else:
-            title = f"{school_name}__{course_name}__{professor_name}"
-        return title
+        self._document_title = self.resolver.get_document_title(
+            self.request.POST, self.gb_school, self.gb_course)
+        return self._document_title
 
     def generate_document(self):
         _document = Document(
@@ -199,15 +130,45 @@ class SeedUploadDoc:
 
     def create_document(self):
         _document = self.generate_document()
-        # todo add unique value to doc name
-        _document.document.save(
-            self.file_name,
-            self.file_object.file,
-            save=False)
+        _document.md5 = Document.get_file_md5(self.file_object.file)
 
-        _document.updated_at = datetime.utcnow()
+        original = Document.find_stored_duplicate(_document.md5)
+        if original is not None:
+            # The same content is stored and converted already
+            _document.link_stored_file(original)
+            _document.updated_at = datetime.utcnow()
+            _document.save(ignore_convert=True)
+            return _document
+
+        # The document gets its id now
         _document.save(ignore_convert=True)
-        _document.convert_document()
+
+        file_name, file_object = self.file_name, self.file_object
+        convert_document = self.convert_document
+        wait_for_convert = self.wait_for_convert
+
+        def finalize(document):
+            # todo add unique value to doc name
+            StorageHandoff.save(document.document, file_name, file_object.file)
+
+            # Fields edited since the upload are kept, only the stored
+            # file is written back
+            document.updated_at = datetime.utcnow()
+            document.save(
+                ignore_convert=True,
+                update_fields=['document', 'updated_at'])
+            if convert_document and wait_for_convert:
+                document.convert_document()
+            elif convert_document:
+                ConversionScheduler.submit(
+                    [document.id], ConversionScheduler.SEED)
+
+        # The file object is closed by the finalizer
+        self._is_finalizing = True
+        UploadFinalizer.submit(
+            _document, finalize,
+            cleanup=file_object.close,
+            wait=self.wait_for_convert)
         return _document
 
     def run(self):
@@ -223,7 +184,8 @@ class SeedUploadDoc:
             error = str(ex)
 
         file_object = getattr(self, "_file_object", None)
-        if file_object is not None:
+        is_finalizing = getattr(self, "_is_finalizing", False)
+        if file_object is not None and not is_finalizing:
             file_object.close()  # remove file from tmp dir
 
         return document, is_processed, error
@@ -0,0 +1,168 @@
+from django.contrib.auth.models import User
+from django.db.models import F, Value
+from django.db.models.functions import Concat
+
+from accounts.models import UserProfile
+from school.models import (
+    School,
+    CourseStructure,
+    Course,
+    Professor,
+    Term,
+)
+from services.school_course_index import LookupNotIndexed, SchoolCourseIndex
+
+
+class SeedUploadResolver:
+    """
+    Seed upload lookups of the user, schools and courses.
+    Every distinct value is resolved once per resolver, so a batch of
+    uploads shares one resolver
+    """
+
+    def __init__(self):
+        self._schools = {}
+        self._course_structures = {}
+        self._courses = {}
+        self._professors = {}
+        self._terms = {}
+
+    @property
+    def user(self):
+        if hasattr(self, "_user"):
+            return self._user
+
+        user = User.objects.filter(username='admin@test.com').first()
+        profile = getattr(user, "profile", None)
+        if profile is None:
+            UserProfile.objects.create(user=user, alias="admin1",
+                                       school=self.default_school)
+
+        self._user = user
+        return self._user
+
+    @property
+    def index(self) -> SchoolCourseIndex:
+        return SchoolCourseIndex.get()
+
+    @property
+    def default_school(self):
+        if hasattr(self, "_default_school"):
+            return self._default_school
+
+        self._default_school = self.index.find_school('short_name', 'UCLA')
+        return self._default_school
+
+    def get_school(self, school_name, school_lookup=None):
+        """
+        School found by school_lookup or the default school
+        """
+        school_lookup = school_lookup or "lookup"
+        key = (school_name, school_lookup)
+        if key in self._schools:
+            return self._schools[key]
+
+        try:
+            school = self.index.find_school(school_lookup, school_name)
+        except LookupNotIndexed:
+            lookup_concat = Concat(F("short_name"), Value(": "), F("name"))
+            school = School.objects \
+                .annotate(lookup=lookup_concat) \
+                .filter(**{school_lookup: school_name}) \
+                .first()
+
+        if not school:
+            school = self.default_school
+
+        self._schools[key] = school
+        return school
+
+    def get_course_structure(self, school, course_name, course_lookup=None):
+        course_lookup = course_lookup or "short_name"
+        key = (school.id, course_name, course_lookup)
+        if key in self._course_structures:
+            return self._course_structures[key]
+
+        try:
+            course_structure = self.index.find_course_structure(
+                school.id, course_lookup, course_name)
+        except LookupNotIndexed:
+            course_structure = CourseStructure.objects.filter(
+                **{course_lookup: course_name},
+                school_id=school.id
+            ).first()
+
+        self._course_structures[key] = course_structure
+        return course_structure
+
+    def get_professor(self, school):
+        if school.id in self._professors:
+            return self._professors[school.id]
+
+        professor = Professor.objects \
+            .filter(first_name__iexact="A",
+                    last_name__iexact="Staff",
+                    school_id=school.id) \
+            .first()
+
+        if not professor:
+            professor = Professor(
+                first_name='A',
+                last_name='Staff',
+                full_name='Staff, A',
+                school_id=school.id)
+            professor.save()
+
+        self._professors[school.id] = professor
+        return professor
+
+    def get_term(self, school):
+        if school.id not in self._terms:
+            self._terms[school.id], _ = Term.objects.get_or_create(
+                school_id=school.id, year=1)
+        return self._terms[school.id]
+
+    def get_course(self, school, course_name, course_lookup=None):
+        """
+        Crowd course of the course structure for the staff professor
+        """
+        if not school:
+            return None
+
+        course_structure = self.get_course_structure(
+            school, course_name, course_lookup)
+        if not course_structure:
+            return None
+
+        if course_structure.id in self._courses:
+            return self._courses[course_structure.id]
+
+        professor = self.get_professor(school)
+        term = self.get_term(school)
+        course, _ = Course.objects.get_or_create(
+            term=term,
+            course_structure=course_structure,
+            professor=professor,
+            status=Course.CROWD)
+
+        self._courses[course_structure.id] = course
+        return course
+
+    @staticmethod
+    def get_document_title(params, gb_school, gb_course):
+        doc_name, school_name, course_name, professor_name = (
+            params.get("name") or "UndefinedDocName",
+            params.get("school") or "UndefinedSchool",
+            params.get("course") or "UndefinedCourse",
+            params.get("professor") or "UndefinedProfessor"
+        )
+
+        if gb_school and gb_course:
+            title = doc_name
+
+        elif gb_school and not gb_course:
+            title = f"{gb_school.name}__{course_name}__{professor_name}"
+
+        else:
+            title = f"{school_name}__{course_name}__{professor_name}"
+        return title
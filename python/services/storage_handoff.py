@@ -0,0 +1,129 @@
+import errno
+import os
+import shutil
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+
+class StorageHandoff:
+    """
+    Saves an assembled upload file to a FileField without copying it
+    through Python buffers.
+    For a local or NFS storage the file is hard linked into place when
+    it is on the same filesystem, otherwise the kernel copies it with
+    copy_file_range or sendfile. Remote storages get the file in large
+    blocks
+    """
+    # Multiple of the 256 KiB chunk of resumable cloud uploads
+    remote_block_size = 8 * 1024 * 1024
+    file_permissions_mode = 0o644
+
+    @classmethod
+    def save(cls, field_file, name, temp_file):
+        """
+        Same as field_file.save(name, temp_file, save=False)
+        """
+        if hasattr(temp_file, 'flush'):
+            # Data written by the upload may still be in the buffer
+            temp_file.flush()
+
+        storage = field_file.storage
+        name = field_file.field.generate_filename(field_file.instance, name)
+        temp_path = getattr(temp_file, 'name', None)
+
+        if (isinstance(storage, FileSystemStorage)
+                and isinstance(temp_path, str)
+                and os.path.isfile(temp_path)):
+            field_file.name = cls._save_local(
+                storage, name, temp_path, field_file.field.max_length)
+        else:
+            content = File(temp_file)
+            content.DEFAULT_CHUNK_SIZE = cls.remote_block_size
+            field_file.name = storage.save(
+                name, content, max_length=field_file.field.max_length)
+
+        setattr(field_file.instance, field_file.field.attname, field_file.name)
+        field_file._committed = True
+
+    @classmethod
+    def _save_local(cls, storage, name, temp_path, max_length):
+        while True:
+            name = storage.get_available_name(name, max_length=max_length)
+            full_path = storage.path(name)
+            os.makedirs(
+                os.path.dirname(full_path),
+                mode=storage.directory_permissions_mode or 0o777,
+                exist_ok=True)
+
+            try:
+                cls._place_file(temp_path, full_path)
+                break
+            except FileExistsError:
+                # Another upload took the name, get the next free one
+                continue
+
+        os.chmod(
+            full_path,
+            storage.file_permissions_mode or cls.file_permissions_mode)
+        return name.replace('\\', '/')
+
+    @classmethod
+    def _place_file(cls, temp_path, full_path):
+        """
+        Raises FileExistsError instead of overwriting full_path
+        """
+        try:
+            # The temp file keeps its own name until it is closed
+            os.link(temp_path, full_path)
+            return
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP,
+                                errno.EMLINK):
+                raise
+
+        size = os.path.getsize(temp_path)
+        source_fd = os.open(temp_path, os.O_RDONLY)
+        try:
+            target_fd = os.open(
+                full_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                cls._copy_file(source_fd, target_fd, size)
+            except BaseException:
+                os.close(target_fd)
+                os.remove(full_path)
+                raise
+            os.close(target_fd)
+        finally:
+            os.close(source_fd)
+
+    @classmethod
+    def _copy_file(cls, source_fd, target_fd, size):
+        """
+        Copy inside the kernel when the platform allows it
+        """
+        offset = 0
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        try:
+            while offset < size:
+                if copy_file_range is not None:
+                    copied = copy_file_range(
+                        source_fd, target_fd, size - offset)
+                else:
+                    copied = os.sendfile(
+                        target_fd, source_fd, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                errno.ENOTSUP, errno.EBADF, errno.ENOTSOCK):
+                raise
+
+        # Neither of them supports these filesystems
+        os.lseek(source_fd, offset, os.SEEK_SET)
+        os.lseek(target_fd, offset, os.SEEK_SET)
+        with open(source_fd, 'rb', closefd=False) as source, \
+                open(target_fd, 'wb', closefd=False) as target:
+            shutil.copyfileobj(source, target, cls.remote_block_size)
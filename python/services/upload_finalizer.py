@@ -0,0 +1,82 @@
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from models import Document
+
+logger = logging.getLogger('import')
+
+
+class UploadFinalizer:
+    """
+    Stores uploaded files and converts documents in background threads,
+    so the request returns as soon as the document row exists.
+    Progress is read back with get_status().
+    Jobs live in the memory of the worker process, a document whose
+    worker was restarted stays pending
+    """
+    PENDING = 'pending'
+    STORED = 'stored'
+    CONVERTED = 'converted'
+    FAILED = 'failed'
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        # Created on first use, after the server forked its workers
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=getattr(
+                        settings, 'UPLOAD_FINALIZER_WORKERS', 4),
+                    thread_name_prefix='upload-finalizer')
+        return cls._executor
+
+    @classmethod
+    def submit(cls, document, finalize, cleanup=None, wait=False):
+        """
+        Run finalize(document) after the document row is committed
+        :param cleanup: called when finalize is done, removes temporary
+        files that finalize reads
+        :param wait: finalize in the current thread, errors are raised
+        """
+        if wait:
+            try:
+                finalize(document)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            return
+
+        def run():
+            try:
+                finalize(document)
+            except Exception as ex:
+                logger.exception(
+                    f"Failed to finalize upload of document {document.id}")
+                Document.objects \
+                    .filter(id=document.id) \
+                    .update(error_msg=str(ex)[:300])
+            finally:
+                if cleanup is not None:
+                    cleanup()
+                # Connection of the executor thread
+                connection.close()
+
+        transaction.on_commit(lambda: cls.get_executor().submit(run))
+
+    @classmethod
+    def get_status(cls, document) -> str:
+        if document.error_msg or document.dc_success is False:
+            return cls.FAILED
+        if document.dc_success:
+            return cls.CONVERTED
+        if document.document:
+            return cls.STORED
+        return cls.PENDING
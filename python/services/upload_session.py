@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from typing import Dict, Optional, Tuple
+
+from models import Document
+
+
+class UploadSession:
+    """
+    Server side state of a chunked plupload upload.
+    Every chunk is written at its own offset of the part file and marked
+    in a bitmap file with one byte per chunk, so chunks may arrive out of
+    order, in parallel requests or in another process, and an interrupted
+    upload is resumed by sending only the missing chunks.
+    The complete part file becomes the upload without another copy.
+    md5 of the upload is calculated while chunks are written when they
+    come in order to this process, otherwise the part file is read once
+    when the upload is complete
+    """
+    directory = 'media/tmp/upload_sessions/'
+    # Sessions without new chunks for this long are removed
+    max_age = 24 * 60 * 60
+    max_hashers = 1000
+
+    # session id: (md5 of the chunks before next chunk, next chunk)
+    _hashers: Dict[str, Tuple['hashlib._Hash', int]] = {}
+
+    def __init__(self, user_id, unique, name):
+        self.user_id = user_id
+        self.unique = unique
+        self.name = name
+
+        key = f'{user_id}:{unique}:{name}'.encode()
+        self.session_id = hashlib.sha1(key).hexdigest()
+        self.md5 = None
+        base_path = os.path.join(self.directory, self.session_id)
+        self.part_path = f'{base_path}.part'
+        self.chunks_path = f'{base_path}.chunks'
+        self.meta_path = f'{base_path}.json'
+        self.done_path = f'{base_path}.done'
+
+    @classmethod
+    def from_request(cls, request) -> 'UploadSession':
+        return cls(
+            request.user.id,
+            request.POST.get('unique') or request.GET.get('unique'),
+            request.POST.get('name') or request.GET.get('name'))
+
+    @staticmethod
+    def is_supported(forms) -> bool:
+        """
+        Chunk offsets are known only when the client sends chunk_size,
+        a single chunk upload doesn't need it
+        """
+        return bool(forms.get('unique')) and (
+            bool(forms.get('chunk_size')) or int(forms.get('chunks', 1)) <= 1)
+
+    def _open_meta(self, chunks, chunk_size):
+        """
+        Create the session files or check that the chunk layout didn't
+        change since the first chunk
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {'chunks': chunks, 'chunk_size': chunk_size}
+
+        # The meta file appears complete or not at all: it is written
+        # aside and linked into place, the link fails if another request
+        # created the session first
+        fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', prefix=f'{self.session_id}.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.link(temp_path, self.meta_path)
+        except FileExistsError:
+            if self.get_meta() != meta:
+                raise ValueError('Chunk layout of the upload changed')
+        else:
+            self.delete_stale_sessions()
+        finally:
+            os.remove(temp_path)
+
+        fd = os.open(self.chunks_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Same length for every request, received marks are kept
+            os.ftruncate(fd, chunks)
+        finally:
+            os.close(fd)
+
+    def get_meta(self) -> Optional[dict]:
+        try:
+            with open(self.meta_path) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    def get_received_chunks(self) -> list:
+        try:
+            with open(self.chunks_path, 'rb') as chunks_file:
+                bitmap = chunks_file.read()
+        except FileNotFoundError:
+            return []
+        return [chunk for chunk, received in enumerate(bitmap) if received]
+
+    def status(self) -> dict:
+        meta = self.get_meta() or {}
+        return {
+            'chunks': meta.get('chunks'),
+            'chunk_size': meta.get('chunk_size'),
+            'received': self.get_received_chunks(),
+        }
+
+    def write_chunk(self, chunk, chunks, chunk_size, uploaded_file):
+        """
+        Write uploaded_file at the offset of chunk
+        :return: open part file when this chunk completed the upload,
+        otherwise None. The caller closes it and calls delete()
+        """
+        if not 0 <= chunk < chunks:
+            raise ValueError(f'Chunk {chunk} is out of {chunks} chunks')
+        if chunks > 1 and not chunk_size:
+            raise ValueError('chunk_size is required for chunked uploads')
+
+        self._open_meta(chunks, chunk_size)
+
+        hasher = self._take_hasher(chunk)
+
+        offset = chunk * chunk_size
+        fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            written = 0
+            for data in uploaded_file.chunks():
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+                if hasher is not None:
+                    hasher.update(data)
+        finally:
+            os.close(fd)
+
+        if hasher is not None:
+            self._put_hasher(hasher, chunk + 1)
+
+        if chunk < chunks - 1 and written != chunk_size:
+            raise ValueError(
+                f'Chunk {chunk} has {written} bytes instead of {chunk_size}')
+
+        # The mark is written after the data, a marked chunk is complete
+        fd = os.open(self.chunks_path, os.O_RDWR)
+        try:
+            os.pwrite(fd, b'\x01', chunk)
+            bitmap = os.pread(fd, chunks, 0)
+        finally:
+            os.close(fd)
+
+        if bitmap.count(b'\x01') < chunks:
+            return None
+        return self._finalize(chunks)
+
+    def _take_hasher(self, chunk):
+        """
+        md5 of the previous chunks when chunk is the next one.
+        The hasher is removed while the chunk is written, so parallel
+        requests don't hash the same chunk twice
+        """
+        if chunk == 0:
+            return hashlib.md5()
+
+        hasher, next_chunk = self._hashers.pop(self.session_id, (None, None))
+        if next_chunk != chunk:
+            return None
+        return hasher
+
+    def _put_hasher(self, hasher, next_chunk):
+        if len(self._hashers) >= self.max_hashers:
+            # Drop the oldest session, its md5 is read from the file
+            self._hashers.pop(next(iter(self._hashers)), None)
+        self._hashers[self.session_id] = (hasher, next_chunk)
+
+    def _finalize(self, chunks):
+        """
+        Only one of concurrent requests with the last chunks wins
+        the rename and gets the file
+        """
+        try:
+            os.rename(self.part_path, self.done_path)
+        except FileNotFoundError:
+            return None
+
+        part_file = open(self.done_path, 'rb')
+        hasher, next_chunk = self._hashers.pop(self.session_id, (None, None))
+        if next_chunk == chunks:
+            self.md5 = hasher.hexdigest()
+        else:
+            self.md5 = Document.get_file_md5(part_file)
+        return part_file
+
+    def delete(self):
+        self._hashers.pop(self.session_id, None)
+        for path in (self.part_path, self.chunks_path, self.meta_path,
+                     self.done_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def delete_stale_sessions(cls):
+        """
+        Remove files of abandoned uploads
+        """
+        expires_at = time.time() - cls.max_age
+        with os.scandir(cls.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < expires_at:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
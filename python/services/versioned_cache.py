@@ -0,0 +1,41 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+class VersionedCache:
+    """
+    Base of process-local caches that every worker keeps its own copy
+    of. A copy is stamped with the version token it was loaded with,
+    a new shared token in the Django cache makes all workers reload.
+    A counter could start over after the key is evicted and repeat the
+    number of an outdated copy, a random token can't
+    """
+    version_key: str = None
+
+    # (version token, ...) of the copy of this process
+    _state = None
+
+    @classmethod
+    def get_version(cls) -> str:
+        version = cache.get(cls.version_key)
+        if version is None:
+            token = uuid.uuid4().hex
+            cache.add(cls.version_key, token, timeout=None)
+            # Without a working cache every call gets a new token
+            version = cache.get(cls.version_key, token)
+        return version
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Make every worker reload after the current transaction
+        is committed
+        """
+        transaction.on_commit(cls._bump_version)
+
+    @classmethod
+    def _bump_version(cls):
+        cls._state = None
+        cache.set(cls.version_key, uuid.uuid4().hex, timeout=None)
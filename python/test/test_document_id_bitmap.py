@@ -0,0 +1,71 @@
+import random
+import unittest
+
+from services.document_id_bitmap import DocumentIdBitmap
+
+
+class TestDocumentIdBitmap(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+        self.document_ids = set(random.sample(range(1, 200000), 5000))
+
+    def test_from_ids(self):
+        bitmap = DocumentIdBitmap.from_ids(self.document_ids)
+
+        self.assertEqual(len(bitmap), len(self.document_ids))
+        for document_id in self.document_ids:
+            self.assertIn(document_id, bitmap)
+        for document_id in range(1, 200000, 997):
+            self.assertEqual(
+                document_id in bitmap, document_id in self.document_ids)
+
+    def test_add_is_idempotent(self):
+        bitmap = DocumentIdBitmap.from_ids([0, 7, 8, 9])
+        bitmap.add(8)
+
+        self.assertEqual(len(bitmap), 4)
+        self.assertIn(0, bitmap)
+        self.assertNotIn(1, bitmap)
+
+    def test_discard(self):
+        bitmap = DocumentIdBitmap.from_ids([3, 4, 5])
+        bitmap.discard(4)
+        bitmap.discard(4)
+        bitmap.discard(10 ** 6)
+
+        self.assertEqual(len(bitmap), 2)
+        self.assertNotIn(4, bitmap)
+        self.assertIn(3, bitmap)
+        self.assertIn(5, bitmap)
+
+    def test_ids_out_of_range(self):
+        bitmap = DocumentIdBitmap.from_ids([1, 2])
+
+        self.assertNotIn(10 ** 9, bitmap)
+        self.assertNotIn(0, DocumentIdBitmap())
+        self.assertEqual(len(DocumentIdBitmap()), 0)
+
+    def test_dumps_loads(self):
+        bitmap = DocumentIdBitmap.from_ids(self.document_ids)
+        loaded = DocumentIdBitmap.loads(bitmap.dumps())
+
+        self.assertEqual(len(loaded), len(self.document_ids))
+        for document_id in self.document_ids:
+            self.assertIn(document_id, loaded)
+        self.assertNotIn(max(self.document_ids) + 1, loaded)
+
+    def test_loaded_bitmap_grows(self):
+        bitmap = DocumentIdBitmap.loads(
+            DocumentIdBitmap.from_ids([5]).dumps())
+        bitmap.add(100000)
+
+        self.assertIn(5, bitmap)
+        self.assertIn(100000, bitmap)
+        self.assertEqual(len(bitmap), 2)
+
+    def test_dumps_of_empty_bitmap(self):
+        bitmap = DocumentIdBitmap.from_ids([100])
+        bitmap.discard(100)
+
+        self.assertEqual(
+            len(DocumentIdBitmap.loads(bitmap.dumps())), 0)
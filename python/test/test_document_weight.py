@@ -0,0 +1,85 @@
+import unittest
+
+from unittest import mock
+
+from services.document_id_bitmap import DocumentIdBitmap
+from services import document_weight
+from services.document_weight import DocumentWeightService
+from models import DocumentWeightGeneration
+
+
+class RefreshFreeDocumentsTestUtils(object):
+    weights = {1: 0.5, 2: 1.5, 3: 2.5, 4: 3.5}
+
+    @staticmethod
+    def get_setting(weight_avg_percentage):
+        generation = mock.Mock(free_access_weight=None)
+        setting = mock.Mock(
+            id=1, weight_avg=2.0, weight_avg_percentage=weight_avg_percentage,
+            generation=generation)
+        return setting
+
+    @classmethod
+    def filter_weights(cls, document_paywall_setting, weight__lte):
+        document_ids = [
+            document_id for document_id, weight in cls.weights.items()
+            if weight <= weight__lte
+        ]
+        queryset = mock.Mock()
+        queryset.values_list.return_value.iterator.return_value = \
+            iter(document_ids)
+        return queryset
+
+
+class TestRefreshFreeDocuments(unittest.TestCase):
+    def setUp(self):
+        self.setting = RefreshFreeDocumentsTestUtils.get_setting(50)
+
+        patchers = [
+            mock.patch.object(
+                DocumentWeightGeneration, 'get_active_paywall_setting',
+                return_value=self.setting),
+            mock.patch('services.document_weight.DocumentWeight'),
+            mock.patch('services.document_weight.transaction.atomic'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        document_weight.DocumentWeight.objects.filter.side_effect = \
+            RefreshFreeDocumentsTestUtils.filter_weights
+
+        DocumentWeightService.publish_free_documents(self.setting)
+
+    def get_free_documents(self):
+        return DocumentIdBitmap.loads(self.setting.generation.free_documents)
+
+    def test_published_with_setting_threshold(self):
+        self.assertEqual(self.setting.generation.free_documents_weight, 1.0)
+        free_documents = self.get_free_documents()
+        self.assertEqual(len(free_documents), 1)
+        self.assertIn(1, free_documents)
+
+    def test_edit_applies_new_threshold(self):
+        self.setting.weight_avg_percentage = 150
+
+        self.assertTrue(
+            DocumentWeightService.refresh_free_documents(self.setting))
+        self.assertEqual(self.setting.generation.free_documents_weight, 3.0)
+        free_documents = self.get_free_documents()
+        self.assertEqual(len(free_documents), 3)
+        self.assertIn(3, free_documents)
+        self.assertNotIn(4, free_documents)
+
+    def test_unchanged_threshold(self):
+        self.assertFalse(
+            DocumentWeightService.refresh_free_documents(self.setting))
+
+    def test_inactive_setting(self):
+        setting = RefreshFreeDocumentsTestUtils.get_setting(50)
+        setting.id = 2
+        setting.generation.free_documents = b''
+        setting.generation.free_documents_weight = 1.0
+        setting.weight_avg_percentage = 150
+
+        self.assertFalse(
+            DocumentWeightService.refresh_free_documents(setting))
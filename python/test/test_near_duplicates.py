@@ -0,0 +1,86 @@
+import random
+import unittest
+
+from services.near_duplicates import MinHasher
+
+
+class MinHasherTestUtils(object):
+    @staticmethod
+    def get_text(seed, words=300):
+        generator = random.Random(seed)
+        return ' '.join(
+            f'word{generator.randrange(5000)}' for _ in range(words))
+
+    @staticmethod
+    def edit_text(text, every=50):
+        words = text.split()
+        for i in range(0, len(words), every):
+            words[i] = 'edited'
+        return ' '.join(words)
+
+
+class TestMinHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = MinHasher()
+        self.text = MinHasherTestUtils.get_text(1)
+
+    def test_identical_texts(self):
+        signature = self.hasher.get_signature(self.text)
+
+        self.assertEqual(len(signature), self.hasher.permutations)
+        self.assertEqual(MinHasher.get_similarity(
+            signature, self.hasher.get_signature(self.text)), 1.0)
+
+    def test_signature_ignores_case_and_punctuation(self):
+        self.assertEqual(
+            self.hasher.get_signature('The quick, brown fox!'),
+            self.hasher.get_signature('the quick brown FOX'))
+
+    def test_near_duplicates(self):
+        signature = self.hasher.get_signature(self.text)
+        other = self.hasher.get_signature(
+            MinHasherTestUtils.edit_text(self.text))
+
+        self.assertGreater(MinHasher.get_similarity(signature, other), 0.6)
+        self.assertTrue(
+            set(self.hasher.get_buckets(signature))
+            & set(self.hasher.get_buckets(other)))
+
+    def test_unrelated_texts(self):
+        signature = self.hasher.get_signature(self.text)
+        other = self.hasher.get_signature(MinHasherTestUtils.get_text(2))
+
+        self.assertLess(MinHasher.get_similarity(signature, other), 0.1)
+        self.assertFalse(
+            set(self.hasher.get_buckets(signature))
+            & set(self.hasher.get_buckets(other)))
+
+    def test_signatures_are_comparable_between_hashers(self):
+        self.assertEqual(
+            self.hasher.get_signature(self.text),
+            MinHasher().get_signature(self.text))
+
+    def test_buckets(self):
+        buckets = self.hasher.get_buckets(
+            self.hasher.get_signature(self.text))
+
+        self.assertEqual(len(buckets), self.hasher.bands)
+        for bucket in buckets:
+            self.assertTrue(-2 ** 63 <= bucket < 2 ** 63)
+
+    def test_short_and_empty_texts(self):
+        self.assertEqual(len(self.hasher.get_signature('two words')),
+                         self.hasher.permutations)
+        self.assertEqual(len(self.hasher.get_signature('')), 0)
+        self.assertEqual(len(self.hasher.get_signature('... !')), 0)
+
+    def test_similarity_of_empty_signatures(self):
+        signature = self.hasher.get_signature(self.text)
+        empty = self.hasher.get_signature('')
+
+        self.assertEqual(MinHasher.get_similarity(empty, empty), 0.0)
+        self.assertEqual(MinHasher.get_similarity(signature, empty), 0.0)
+
+    def test_bands_must_divide_permutations(self):
+        with self.assertRaises(ValueError):
+            MinHasher(permutations=100, bands=32)
@@ -0,0 +1,96 @@
+import random
+import unittest
+
+from services.quantile_sketch import KLLSketch
+
+
+class KLLSketchTestUtils(object):
+    @staticmethod
+    def build_sketch(values, k=200):
+        sketch = KLLSketch(k=k)
+        for value in values:
+            sketch.update(value)
+        return sketch
+
+    @staticmethod
+    def get_rank(values, value):
+        """
+        Exact share of values that are less or equal to value
+        """
+        return sum(1 for item in values if item <= value) / len(values)
+
+
+class TestKLLSketch(unittest.TestCase):
+    # About 1.7 / k with k=200, with a margin for the random compactions
+    max_rank_error = 0.02
+
+    def setUp(self):
+        random.seed(7)
+        self.values = [random.uniform(-50, 50) for _ in range(50000)]
+
+    def test_quantile_rank_error(self):
+        sketch = KLLSketchTestUtils.build_sketch(self.values)
+
+        sorted_values = sorted(self.values)
+        for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+            value = sketch.quantile(q)
+            rank = KLLSketchTestUtils.get_rank(sorted_values, value)
+            self.assertLess(abs(rank - q), self.max_rank_error, q)
+
+    def test_rank_error(self):
+        sketch = KLLSketchTestUtils.build_sketch(self.values)
+
+        for value in (-40, -10, 0, 10, 40):
+            self.assertLess(
+                abs(sketch.rank(value)
+                    - KLLSketchTestUtils.get_rank(self.values, value)),
+                self.max_rank_error, value)
+
+    def test_size_is_bounded(self):
+        sketch = KLLSketchTestUtils.build_sketch(self.values)
+
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertLess(sketch._size, 1000)
+
+    def test_merge(self):
+        middle = len(self.values) // 2
+        sketch = KLLSketchTestUtils.build_sketch(self.values[:middle])
+        sketch.merge(
+            KLLSketchTestUtils.build_sketch(self.values[middle:]))
+
+        self.assertEqual(sketch.count, len(self.values))
+        sorted_values = sorted(self.values)
+        for q in (0.1, 0.5, 0.9):
+            rank = KLLSketchTestUtils.get_rank(
+                sorted_values, sketch.quantile(q))
+            self.assertLess(abs(rank - q), self.max_rank_error, q)
+
+    def test_merge_of_unequal_sketches(self):
+        sketch = KLLSketchTestUtils.build_sketch(range(10))
+        sketch.merge(KLLSketchTestUtils.build_sketch(range(10, 20000)))
+
+        self.assertEqual(sketch.count, 20000)
+        self.assertLess(abs(sketch.quantile(0.5) - 10000), 20000 * 0.02)
+
+    def test_small_stream_is_exact(self):
+        sketch = KLLSketchTestUtils.build_sketch([5, 1, 4, 2, 3])
+
+        self.assertEqual(sketch.quantile(0), 1)
+        self.assertEqual(sketch.quantile(0.5), 3)
+        self.assertEqual(sketch.quantile(1), 5)
+        self.assertEqual(sketch.rank(2), 0.4)
+
+    def test_empty_sketch(self):
+        sketch = KLLSketch()
+
+        self.assertIsNone(sketch.quantile(0.5))
+        self.assertEqual(sketch.rank(1), 0)
+
+    def test_dumps_loads(self):
+        sketch = KLLSketchTestUtils.build_sketch(self.values)
+        loaded = KLLSketch.loads(sketch.dumps())
+
+        self.assertEqual(loaded.count, sketch.count)
+        self.assertEqual(loaded.k, sketch.k)
+        for q in (0.1, 0.5, 0.9):
+            self.assertEqual(loaded.quantile(q), sketch.quantile(q))
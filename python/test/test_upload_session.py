@@ -0,0 +1,110 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from django.core.files.base import ContentFile
+
+from services.upload_session import UploadSession
+
+
+class TestUploadSession(unittest.TestCase):
+    chunk_size = 1024
+    chunks = 5
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = mock.patch.object(
+            UploadSession, 'directory', temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.data = os.urandom(self.chunk_size * (self.chunks - 1) + 100)
+        self.session = self.get_session()
+        self.addCleanup(self.session.delete)
+
+    def get_session(self):
+        return UploadSession(1, 'unique', 'name.pdf')
+
+    def write_chunk(self, chunk, session=None, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        data = self.data[chunk * chunk_size:(chunk + 1) * chunk_size]
+        return (session or self.session).write_chunk(
+            chunk, self.chunks, chunk_size, ContentFile(data))
+
+    def assertUploaded(self, part_file, session=None):
+        self.assertIsNotNone(part_file)
+        with part_file:
+            self.assertEqual(part_file.read(), self.data)
+        self.assertEqual((session or self.session).md5,
+                         hashlib.md5(self.data).hexdigest())
+
+    def test_in_order(self):
+        for chunk in range(self.chunks - 1):
+            self.assertIsNone(self.write_chunk(chunk))
+
+        self.assertUploaded(self.write_chunk(self.chunks - 1))
+
+    def test_out_of_order(self):
+        for chunk in (3, 0, 4, 2):
+            self.assertIsNone(self.write_chunk(chunk))
+
+        self.assertUploaded(self.write_chunk(1))
+
+    def test_resume(self):
+        for chunk in (0, 1, 3):
+            self.write_chunk(chunk)
+
+        # Another request, possibly of another process
+        session = self.get_session()
+        UploadSession._hashers.clear()
+        status = session.status()
+        self.assertEqual(status, {
+            'chunks': self.chunks,
+            'chunk_size': self.chunk_size,
+            'received': [0, 1, 3],
+        })
+
+        missing = [chunk for chunk in range(self.chunks)
+                   if chunk not in status['received']]
+        part_file = None
+        for chunk in missing:
+            part_file = self.write_chunk(chunk, session=session)
+        self.assertUploaded(part_file, session=session)
+
+    def test_repeated_chunk(self):
+        for chunk in (0, 1, 1, 2, 3):
+            self.write_chunk(chunk)
+
+        self.assertUploaded(self.write_chunk(4))
+
+    def test_status_of_new_session(self):
+        self.assertEqual(self.session.status(), {
+            'chunks': None, 'chunk_size': None, 'received': []})
+
+    def test_layout_change(self):
+        self.write_chunk(0)
+
+        with self.assertRaises(ValueError):
+            self.write_chunk(1, chunk_size=self.chunk_size * 2)
+
+    def test_chunk_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.session.write_chunk(
+                self.chunks, self.chunks, self.chunk_size, ContentFile(b''))
+
+    def test_short_chunk(self):
+        with self.assertRaises(ValueError):
+            self.session.write_chunk(
+                0, self.chunks, self.chunk_size, ContentFile(b'short'))
+        self.assertEqual(self.session.get_received_chunks(), [])
+
+    def test_delete(self):
+        self.write_chunk(0)
+        self.session.delete()
+
+        self.assertEqual(self.session.status()['received'], [])
+        self.assertEqual(os.listdir(UploadSession.directory), [])
@@ -24,6 +24,12 @@ from models import (
     EssayDocument, Tag, DocumentsDownloadRequests, DocumentVisit
 )
 from services import SeedUploadDoc
+from services.conversion_scheduler import ConversionScheduler
+from services.entitlements import DocumentEntitlements
+from services.seed_upload_batch import SeedUploadBatch
+from services.storage_handoff import StorageHandoff
+from services.upload_finalizer import UploadFinalizer
+from services.upload_session import UploadSession
 
 
 @login_required
@@ -58,7 +64,8 @@ def add_comment(request, document_id):
         raise Http404('No %s matches the given query.' % Document)
     document = get_object_or_404(Document, id=document_id)
 
-    if not document.access_allowed(request.user):
+    entitlements = DocumentEntitlements.for_request(request)
+    if not document.access_allowed(request.user, entitlements):
         link = reverse(
             'course_document_slug', args=[document.id, document.slug])
         return HttpResponseRedirect(
@@ -95,7 +102,8 @@ def add_comment(request, document_id):
 def add_tags(request, document_id):
     document = get_object_or_404(Document, id=document_id)
 
-    if not document.access_allowed(request.user):
+    entitlements = DocumentEntitlements.for_request(request)
+    if not document.access_allowed(request.user, entitlements):
         link = reverse(
             'course_document_slug', args=[document.id, document.slug])
         return HttpResponseRedirect(link + "?msg=Tags disabled for preview")
@@ -122,7 +130,8 @@ def remove_tag(request, document_id, tag_id):
 
     tag = get_object_or_404(Tag, id=tag_id)
 
-    if not document.access_allowed(request.user):
+    entitlements = DocumentEntitlements.for_request(request)
+    if not document.access_allowed(request.user, entitlements):
         link = reverse(
             'course_document_slug', args=[document.id, document.slug])
         return HttpResponseRedirect(link + "?msg=Tags disabled for preview")
@@ -133,7 +142,12 @@ def remove_tag(request, document_id, tag_id):
     return HttpResponseRedirect(link + "?msg=Tags removed from document")
 
 
-def _save_uploaded_document(temp_file, user, name, user_essay):
+def _save_uploaded_document(temp_file, user, name, user_essay, md5=None,
+                            cleanup=None):
+    """
+    Create the document and store temp_file in background
+    :param cleanup: removes temp_file after it is stored
+    """
     # TODO: move to model
     title, extension = os.path.splitext(name)
 
@@ -141,11 +155,38 @@ def _save_uploaded_document(temp_file, user, name, user_essay):
     length = 80 - len(extension)
     name = title[:length] + extension
 
-    document = Document(notetaker=user, title=title[:100])
-    document.document.save(name, temp_file, save=False)
+    if md5 is None:
+        md5 = Document.get_file_md5(temp_file)
+
+    document = Document(notetaker=user, title=title[:100], md5=md5)
     document.user_essay = user_essay
     document.updated_at = datetime.datetime.now()
-    document.save()
+
+    original = Document.find_stored_duplicate(md5)
+    if original is not None:
+        # The same content is stored and converted already
+        document.link_stored_file(original)
+        document.save(ignore_convert=True)
+        if cleanup is not None:
+            cleanup()
+        return document
+
+    # The document gets its id now, the file is stored and converted
+    # off the request thread
+    document.save(ignore_convert=True)
+
+    def store(_document):
+        StorageHandoff.save(_document.document, name, temp_file)
+        # The user may be tagging the document meanwhile, only the stored
+        # file is written back
+        _document.updated_at = datetime.datetime.now()
+        _document.save(
+            ignore_convert=True, update_fields=['document', 'updated_at'])
+        ConversionScheduler.submit(
+            [_document.id], ConversionScheduler.get_upload_lane(user))
+
+    UploadFinalizer.submit(document, store, cleanup)
+    return document
 
 
 def _handle_uploaded_file(f, chunk, filepath):
@@ -163,56 +204,102 @@ def _handle_uploaded_file(f, chunk, filepath):
     _file.close()
 
 
-def _handle_valid_upload(request):
-    # Step 1: temp file
-    # this code handles uploading one file, that may be broken
-    # up into pieces
-
-    file_obj = tempfile.NamedTemporaryFile()
+def _save_valid_upload(request, temp_file, md5=None, cleanup=None):
+    # Step 2: save file in GCS and add entry to postgres
     forms = request.POST
     files = request.FILES
-    dest = 'media/tmp/'
 
     text_respons = 'This file seems to have been already uploaded: '
 
     save_file = True
 
-    res = plupload.save_tmp_file_obj(request, forms, files, dest, file_obj)
-
-    if res:
-        # Step 2: save file in GCS and add entry to postgres
+    file_title = files['file'].name
+    untagged_documents = Document.objects \
+        .filter(notetaker=request.user, status=Document.UNTAGGED) \
+        .order_by('-publish_date')
 
-        file_title = files['file'].name
-        untagged_documents = Document.objects \
-            .filter(notetaker=request.user, status=Document.UNTAGGED) \
-            .order_by('-publish_date')
-
-        try:
+    try:
+        if file_title.split(".")[0] in untagged_documents.values_list(
+                'title', flat=True):
+            save_file = False
+            request.session[
+                'duplicate_text'] = f'{text_respons} <b>{file_title}</b>'
+        elif file_title == 'blob':
+            file_title = forms['name']
             if file_title.split(".")[0] in untagged_documents.values_list(
                     'title', flat=True):
                 save_file = False
                 request.session[
-                    'duplicate_text'] = f'{text_respons} <b>{file_title}</b>'
-            elif file_title == 'blob':
-                file_title = forms['name']
-                if file_title.split(".")[0] in untagged_documents.values_list(
-                        'title', flat=True):
-                    save_file = False
-                    request.session[
-                        'duplicate_text'] = (f'{text_respons} <b>'
-                                             f'{file_title}</b>')
-        except:
-            pass
-
-        if save_file:
-            user_essay = request.POST.get('user_essay', False) is not False
-            _save_uploaded_document(
-                temp_file=file_obj.file,
-                user=request.user,
-                name=request.POST.get('name'),
-                user_essay=user_essay)
-            # Step 3: cleanup
-            file_obj.close()  # automatically deleted when closed
+                    'duplicate_text'] = (f'{text_respons} <b>'
+                                         f'{file_title}</b>')
+    except:
+        pass
+
+    if not save_file:
+        if cleanup is not None:
+            cleanup()
+        return None
+
+    user_essay = request.POST.get('user_essay', False) is not False
+    return _save_uploaded_document(
+        temp_file=temp_file,
+        user=request.user,
+        name=request.POST.get('name'),
+        user_essay=user_essay,
+        md5=md5,
+        cleanup=cleanup)
+
+
+def _handle_valid_upload(request):
+    """
+    :return: document created by the last chunk or None
+    """
+    # Step 1: temp file
+    # this code handles uploading one file, that may be broken
+    # up into pieces
+    forms = request.POST
+    files = request.FILES
+
+    if UploadSession.is_supported(forms):
+        # Chunks are written in place and may come in any order
+        session = UploadSession.from_request(request)
+        part_file = session.write_chunk(
+            chunk=int(forms.get('chunk', 0)),
+            chunks=int(forms.get('chunks', 1)),
+            chunk_size=int(forms.get('chunk_size', 0)),
+            uploaded_file=files['file'])
+        if part_file is None:
+            return None
+
+        # Step 3: cleanup, when the file is stored
+        def cleanup():
+            part_file.close()
+            session.delete()
+
+        try:
+            return _save_valid_upload(
+                request, part_file, session.md5, cleanup)
+        except Exception:
+            cleanup()
+            raise
+
+    # Clients that don't send chunk_size upload chunks in order
+    file_obj = tempfile.NamedTemporaryFile()
+    dest = 'media/tmp/'
+
+    res = plupload.save_tmp_file_obj(request, forms, files, dest, file_obj)
+
+    if not res:
+        # Step 3: cleanup
+        file_obj.close()  # automatically deleted when closed
+        return None
+
+    try:
+        return _save_valid_upload(
+            request, file_obj.file, cleanup=file_obj.close)
+    except Exception:
+        file_obj.close()
+        raise
 
 
 @login_required
@@ -227,12 +314,15 @@ def document_upload_redesign(request):
         unique = request.POST.get('unique')
 
         if form.is_valid() and name and unique:
-            _handle_valid_upload(request)
+            document = _handle_valid_upload(request)
 
             if request.is_ajax():
+                # Stored in background, the client polls
+                # document_upload_status with document_id
+                result = {'document_id': document.id} if document else None
                 response = HttpResponse(
-                    content='{"jsonrpc" : "2.0", "result" : null, "id" : '
-                            '"id"}',
+                    content=json.dumps({
+                        'jsonrpc': '2.0', 'result': result, 'id': 'id'}),
                     content_type='text/plain; charset=UTF-8')
                 response['Expires'] = 'Mon, 1 Jan 2000 01:00:00 GMT'
                 response[
@@ -258,18 +348,83 @@ def document_upload_redesign(request):
     return render(request, template, context)
 
 
+@login_required
+@never_cache
+def document_upload_session(request):
+    """
+    Chunks of an interrupted upload that were already received,
+    the client resumes the upload by sending the rest.
+    Expects unique and name of the upload
+    """
+    session = UploadSession.from_request(request)
+    return JsonResponse(session.status())
+
+
+def _upload_status_response(document):
+    return JsonResponse({
+        'id': document.id,
+        'status': UploadFinalizer.get_status(document),
+        'dc_success': document.dc_success,
+        'error': document.error_msg or '',
+    })
+
+
+@login_required
+@never_cache
+def document_upload_status(request, document_id):
+    """
+    Progress of an upload finalized in background
+    """
+    document = get_object_or_404(
+        Document, id=document_id, notetaker=request.user)
+    return _upload_status_response(document)
+
+
 @csrf_exempt
 @basicauth
 def seed_upload_document(request):
     document, is_processed, error = SeedUploadDoc(request=request).run()
     doc_id = document.id if document else None
     dc_success = document.dc_success if document else False
+    status = UploadFinalizer.get_status(document) if document else None
     resp_data = {
         "id": doc_id,
         "processed": is_processed,
+        "status": status,
         "dc_success": dc_success,
         "error": error
     }
     return HttpResponse(
         json.dumps(resp_data),
         content_type='application/json')
+
+
+@csrf_exempt
+@basicauth
+def seed_upload_documents(request):
+    """
+    Seed upload of a manifest with a zip or tar archive of documents
+    """
+    try:
+        created_ids, errors = SeedUploadBatch(request=request).run()
+    except Exception as ex:
+        created_ids, errors = [], [{"file": None, "error": str(ex)}]
+
+    resp_data = {
+        "ids": created_ids,
+        "errors": errors
+    }
+    return HttpResponse(
+        json.dumps(resp_data),
+        content_type='application/json')
+
+
+@csrf_exempt
+@basicauth
+@never_cache
+def seed_upload_document_status(request, document_id):
+    """
+    Progress of a seed upload finalized in background
+    """
+    document = get_object_or_404(Document, id=document_id)
+    return _upload_status_response(document)